@@ -0,0 +1,349 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy") #headless pygame, must be set before it is imported
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1") #keeps stdout valid JSON
+
+import blur
+import time
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import sys
+import tracemalloc
+import numpy
+
+#Repeatable benchmarks for the hot paths of blur.py. Synthetic images are generated at several resolutions, each
+#case is timed over a number of repeats, and latency percentiles, throughput and peak traced memory are reported as
+#JSON. Given a baseline from an earlier run, cases that got slower than the threshold are reported as regressions.
+
+default_sizes = ["256x256", "1024x768", "2048x1536"]
+geometry = ((1024, 768), (36, 27), 61)
+batch_levels = [40.0, 30.0, 20.0, 14.0, 10.0, 7.0, 5.0, 3.5, 2.0]
+
+#a smooth gradient with some high frequency noise on top, so every filter level has something to remove
+def synthetic_image(cols, rows, seed=0):
+    random = numpy.random.RandomState(seed)
+    (y, x) = numpy.mgrid[0:cols, 0:rows]
+    image = numpy.empty((cols, rows, 3))
+    image[:,:,0] = 255.0 * x / max(rows - 1, 1)
+    image[:,:,1] = 255.0 * y / max(cols - 1, 1)
+    image[:,:,2] = 127.5 + 127.5 * numpy.sin(x / 7.0) * numpy.cos(y / 11.0)
+    image += random.normal(0, 20, image.shape)
+    return numpy.clip(image, 0, 255).astype("uint8")
+
+def parse_size(text):
+    (width, height) = text.lower().split("x")
+    return (int(width), int(height))
+
+def have_module(name):
+    try:
+        __import__(name)
+        return True
+    except ImportError:
+        return False
+
+#times fn() `repeat` times after `warmup` untimed calls. setup() runs before every call and is not timed. Peak memory
+#is traced over one extra call, so tracing does not slow the timed ones down.
+def measure(fn, repeat, warmup=1, setup=None, pixels=None):
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    times_ms = numpy.array(times) * 1000.0
+    result = {
+        "repeat": repeat,
+        "mean_ms": float(times_ms.mean()),
+        "min_ms": float(times_ms.min()),
+        "p50_ms": float(numpy.percentile(times_ms, 50)),
+        "p90_ms": float(numpy.percentile(times_ms, 90)),
+        "p99_ms": float(numpy.percentile(times_ms, 99)),
+        "peak_bytes": int(peak),
+    }
+    median = result["p50_ms"] / 1000.0
+    result["calls_per_s"] = 1.0 / median if median > 0 else None
+    if pixels is not None:
+        result["megapixels_per_s"] = pixels / 1e6 / median if median > 0 else None
+    return result
+
+#main_windowed.window() as it was before the Compositor: a surface, blit and colorkeyed circle per blur level. Kept
+#as the reference the window_frame cases are compared against.
+def surface_window(screen, samples, window_radius, position):
+    import pygame
+    (pos_x, pos_y) = position
+    radius = window_radius - (len(samples) * 2)
+    screen.set_colorkey((0,0,0))
+    screen.blit(samples[-1], (pos_x - radius, pos_y - radius), (pos_x - radius, pos_y - radius, radius*2, radius*2))
+    for index in range(2, len(samples) - 1):
+        radius += 2
+        output = pygame.Surface((radius*2, radius*2))
+        output.blit(samples[-index], (0,0), (pos_x - radius, pos_y - radius, radius*2, radius*2))
+        output.set_colorkey((0,0,0), pygame.RLEACCEL)
+        pygame.draw.circle(output, (0,0,0), (radius, radius), radius)
+        screen.blit(output, (pos_x - radius, pos_y - radius))
+    radius += 2
+    output = samples[0].copy()
+    pygame.draw.circle(output, (0,0,0), position, radius)
+    output.set_colorkey((0,0,0), pygame.RLEACCEL)
+    screen.blit(output, (0,0))
+
+def run_cases(size, repeat, workdir, concurrent, windowed):
+    (width, height) = size
+    image = synthetic_image(height, width) #rows, columns, as PIL lays images out
+    pixels = width * height
+    cases = {}
+
+    path = os.path.join(workdir, "synthetic_{0}x{1}.png".format(width, height))
+    from PIL import Image
+    Image.fromarray(image).save(path)
+
+    cases["open_pil"] = measure(lambda: blur.open(path, blur.Types.PIL), repeat, pixels=pixels)
+    if have_module("pygame"):
+        cases["open_pygame"] = measure(lambda: blur.open(path, blur.Types.PYGAME), repeat, pixels=pixels)
+
+    matrix = blur.BlurringMatrix(image)
+    cases["calcPixelsPerDegree"] = measure(lambda: matrix.calcPixelsPerDegree(*geometry), repeat)
+
+    #the spectrum is released before every call so each one pays for the full filter
+    cases["lowPassFilter"] = measure(lambda: matrix.lowPassFilter(5.0), repeat, setup=matrix.release_spectrum, pixels=pixels)
+    cases["lowPassFilter_cached_spectrum"] = measure(lambda: matrix.lowPassFilter(5.0), repeat, pixels=pixels)
+    #the same filter through a warm Workspace into an existing output; peak_bytes against lowPassFilter shows the allocations saved
+    workspace = blur.Workspace()
+    out = matrix.copy()
+    cases["lowPassFilter_workspace"] = measure(lambda: matrix.lowPassFilter(5.0, method="fft", cache=False, out=out, workspace=workspace), repeat, setup=matrix.release_spectrum, pixels=pixels)
+    if concurrent:
+        try:
+            blur.defaultEngine()
+        except ImportError:
+            pass
+        else:
+            cases["lowPassFilter_concurrent"] = measure(lambda: matrix.lowPassFilter(5.0, concurrent=True), repeat, setup=matrix.release_spectrum, pixels=pixels)
+    cases["lowPassFilterBatch_9"] = measure(lambda: list(matrix.lowPassFilterBatch(batch_levels)), repeat, setup=matrix.release_spectrum, pixels=pixels * len(batch_levels))
+
+    filtered = matrix.lowPassFilter(5.0)
+    cases["exportToPIL"] = measure(lambda: blur.exportToPIL(filtered), repeat, pixels=pixels)
+    if have_module("pygame"):
+        import pygame
+        pygame.init()
+        cases["exportToPygame"] = measure(lambda: blur.exportToPygame(filtered), repeat, pixels=pixels)
+        surface = blur.exportToPygame(filtered)
+        cases["exportToPygame_workspace"] = measure(lambda: blur.exportToPygame(filtered, surface, workspace), repeat, pixels=pixels)
+
+        if windowed:
+            import main_windowed
+            #surfaces are (width, height) while BlurringMatrix keeps PIL's (rows, columns) layout here
+            levels = [blur.BlurringMatrix(level.matrix.transpose(1,0,2)) for level in matrix.lowPassFilterBatch(batch_levels)]
+            samples = [blur.exportToPygame(level) for level in levels]
+            screen = pygame.Surface((width, height))
+            radius = min(300, min(width, height) // 2)
+            positions = [(width // 2, height // 2), (width // 3, height // 3), (2 * width // 3, height // 2)]
+            #hard-edged through window(), smooth through a Compositor, and the original per-level surface version
+            compositor = main_windowed.Compositor(samples, radius, smooth=True)
+            draws = {
+                "window_frame": lambda position: main_windowed.window(screen, samples, radius, position),
+                "window_frame_smooth": lambda position: compositor.draw(screen, position),
+                "window_frame_surfaces": lambda position: surface_window(screen, samples, radius, position),
+            }
+            for (name, draw) in draws.items():
+                frame = iter(range(10**9))
+                cases[name] = measure(lambda: draw(positions[next(frame) % len(positions)]), repeat * 5, pixels=pixels)
+
+    return cases
+
+#times whole short-lived runs in fresh interpreters, where imports and initialization outweigh the filtering itself
+def run_startup(repeat, workdir):
+    here = os.path.dirname(os.path.abspath(__file__))
+    source = os.path.join(workdir, "startup_64x48.png")
+    from PIL import Image
+    Image.fromarray(synthetic_image(48, 64)).save(source)
+    destination = os.path.join(workdir, "startup_out.png")
+
+    commands = {
+        "import_blur": [sys.executable, "-c", "import blur"],
+        "main_pil_small": [sys.executable, os.path.join(here, "main_pil.py"), "5", source, destination],
+    }
+    if have_module("pygame"):
+        commands["main_pygame_small"] = [sys.executable, os.path.join(here, "main_pygame.py"), "5", source, destination]
+
+    cases = {}
+    for (name, command) in commands.items():
+        run = lambda: subprocess.run(command, cwd=here, stdout=subprocess.DEVNULL, check=True)
+        cases[name] = measure(run, repeat)
+    return cases
+
+#Checks of correctness, run along with the benchmarks so that a change to the output is caught as well as a slowdown.
+#Each is given a scratch directory and returns its measured error and the limit the error must stay under.
+
+#the pyramid synthesized at each level's cutoff against lowPassFilter at the same cutoff, as the mean absolute error in
+#grey levels away from the edges. A misaligned level shows up here as several grey levels of error.
+def check_pyramid(workdir, size=512):
+    matrix = blur.BlurringMatrix(synthetic_image(size, size)).calcPixelsPerDegree(*geometry)
+    pyramid = blur.BlurPyramid(matrix)
+    margin = size // 16
+    error = 0.0
+    for cutoff in pyramid.levelCutoffs()[1:5]:
+        difference = numpy.abs(pyramid.synthesize(cutoff) - matrix.lowPassFilter(cutoff).matrix)[margin:-margin, margin:-margin]
+        error = max(error, float(difference.mean()))
+    return (error, 1.5)
+
+#the spatial path against the FFT at a few cutoffs, as the largest absolute difference in grey levels anywhere,
+#edges included. Both compute the same wrapped-around filter, so method="auto" may pick either.
+def check_spatial(workdir, size=256):
+    matrix = blur.BlurringMatrix(synthetic_image(size, size)).calcPixelsPerDegree(*geometry)
+    error = 0.0
+    for cpd in (2.0, 7.0, 14.0):
+        difference = matrix.lowPassFilter(cpd, method="spatial", cache=False).matrix - matrix.lowPassFilter(cpd, method="fft", cache=False).matrix
+        error = max(error, float(numpy.abs(difference).max()))
+    return (error, 0.5)
+
+#a 4:2:0 frame filtered against its 4:4:4 original, filtered and then subsampled the same way, as the mean absolute
+#error in grey levels of the chroma planes. Subsampling and filtering should commute up to rounding.
+def check_chroma_subsampling(workdir, size=512):
+    image = synthetic_image(size, size)
+    ppd = blur.BlurringMatrix(image).calcPixelsPerDegree(*geometry).pixels_per_degree
+    subsample = lambda plane: (plane.reshape(size // 2, 2, size // 2, 2).mean(axis=(1,3)) + 0.5).astype("uint8")
+    planes = tuple(numpy.ascontiguousarray(image[:,:,c]) for c in range(3))
+    full = blur.filterFrame(planes, ppd, 5.0)
+    subsampled = blur.filterFrame((planes[0], subsample(planes[1]), subsample(planes[2])), ppd, 5.0)
+    error = max(float(numpy.abs(subsampled[c].astype("float64") - subsample(full[c])).mean()) for c in (1, 2))
+    return (error, 1.5)
+
+#the first request blur_server.py's workers handle, sent with Connection: close on localhost and read to the end of the
+#stream, as HTTP/1.0 clients do. The error is the seconds until the server closed the connection, or the timeout if it
+#never did, which is what happens when a worker process holds the client's socket open.
+def check_server_close(workdir, timeout=20.0):
+    import socket
+    here = os.path.dirname(os.path.abspath(__file__))
+    from PIL import Image
+    Image.fromarray(synthetic_image(48, 64)).save(os.path.join(workdir, "served.png"))
+    server = subprocess.Popen([sys.executable, os.path.join(here, "blur_server.py"), workdir, "--port", "0", "--workers", "2"], cwd=here, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        port = int(server.stdout.readline().strip().rstrip("/").rsplit(":", 1)[1])
+        connection = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        start = time.perf_counter()
+        try:
+            connection.sendall(b"GET /blur?src=served.png&cpd=5 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            while connection.recv(65536):
+                pass
+            elapsed = time.perf_counter() - start
+        except socket.timeout:
+            elapsed = timeout
+        finally:
+            connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+    return (elapsed, timeout / 2.0)
+
+checks = {"pyramid_vs_lowPassFilter": check_pyramid, "spatial_vs_fft": check_spatial, "chroma_subsampling": check_chroma_subsampling, "server_closes_connection": check_server_close}
+
+def run_checks(workdir):
+    results = {}
+    for (name, check) in checks.items():
+        (error, limit) = check(workdir)
+        results[name] = {"error": error, "limit": limit, "ok": error < limit}
+    return results
+
+#compares each case's median latency against the baseline. Returns a list of the cases slower than threshold times
+#the baseline, each with its ratio.
+def compare(results, baseline, threshold):
+    regressions = []
+    comparison = {}
+    groups = list(results["sizes"].items())
+    if "startup" in results:
+        groups.append(("startup", results["startup"]))
+    for (size, cases) in groups:
+        for (name, case) in cases.items():
+            if size == "startup":
+                before = baseline.get("startup", {}).get(name)
+            else:
+                before = baseline.get("sizes", {}).get(size, {}).get(name)
+            if before is None or not before.get("p50_ms"):
+                continue
+            ratio = case["p50_ms"] / before["p50_ms"]
+            comparison["{0}/{1}".format(size, name)] = ratio
+            if ratio > threshold:
+                regressions.append({"case": "{0}/{1}".format(size, name), "ratio": ratio, "baseline_p50_ms": before["p50_ms"], "p50_ms": case["p50_ms"]})
+    return (comparison, regressions)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the blur hot paths on synthetic images and reports the results as JSON.")
+    parser.add_argument("--sizes", default=",".join(default_sizes), help="Comma separated WIDTHxHEIGHT image sizes to benchmark.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed calls per case.")
+    parser.add_argument("--output", "-o", default=None, help="Write the JSON report here instead of printing it.")
+    parser.add_argument("--baseline", "-b", default=None, help="JSON report from an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=1.25, help="A case regresses when its median is more than this many times the baseline's.")
+    parser.add_argument("--no-concurrent", dest="concurrent", action="store_false", help="Skip the concurrent filtering cases.")
+    parser.add_argument("--no-window", dest="windowed", action="store_false", help="Skip the main_windowed compositing case.")
+    parser.add_argument("--no-startup", dest="startup", action="store_false", help="Skip timing the command line tools from a cold interpreter on a small image.")
+    parser.add_argument("--no-checks", dest="checks", action="store_false", help="Skip the accuracy checks.")
+
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "fft_backend": blur.fftBackendName(),
+        "repeat": args.repeat,
+        "sizes": {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix="blur_benchmark_")
+    try:
+        for text in args.sizes.split(","):
+            size = parse_size(text)
+            results["sizes"]["{0}x{1}".format(*size)] = run_cases(size, args.repeat, workdir, args.concurrent, args.windowed)
+        if args.startup:
+            results["startup"] = run_startup(args.repeat, workdir)
+        if args.checks:
+            results["checks"] = run_checks(workdir)
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        (results["comparison"], regressions) = compare(results, baseline, args.threshold)
+        results["regressions"] = regressions
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    for regression in regressions:
+        print("REGRESSION {case}: {p50_ms:.2f}ms vs {baseline_p50_ms:.2f}ms ({ratio:.2f}x)".format(**regression), file=sys.stderr)
+    failed = [name for (name, check) in results.get("checks", {}).items() if not check["ok"]]
+    for name in failed:
+        print("CHECK FAILED {0}: error {error:.3g}, limit {limit:.3g}".format(name, **results["checks"][name]), file=sys.stderr)
+    if len(regressions) > 0 or len(failed) > 0:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
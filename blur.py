@@ -1,61 +1,239 @@
 import numpy
 import math
 import time
+import collections
+import itertools
+import threading
 
 class Types:
     PIL = 0
     PYGAME = 1
 
-def open(source, base_type=None):
-    if base_type is None:
+#the floating point types filtering can run in. float32 halves memory and bandwidth; against the float64 path its
+#results differ by well under 1e-3 of an 8-bit grey level for images of several megapixels (the rounding error of a
+#float32 FFT grows with 255 * 1.2e-7 * log2(pixels)), so after conversion to uint8 a pixel can differ by at most one
+#level, and only where the float64 result sits within that distance of a whole number.
+float_types = ("float32", "float64")
+
+#the complex type of the spectrum of a real array of the given type
+def complexType(dtype):
+    return numpy.result_type(dtype, numpy.complex64)
+
+def checkFloatType(dtype):
+    dtype = numpy.dtype(dtype)
+    if dtype.name not in float_types:
+        raise ValueError("Filtering can only run in {0}, not {1}.".format(" or ".join(float_types), dtype.name))
+    return dtype
+
+#A stage being timed by Profiler.stage(). add() counts bytes produced by the stage, usually the nbytes of its output.
+class ProfileStage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.bytes = 0
+    def add(self, nbytes):
+        self.bytes += int(nbytes)
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.bytes)
+
+#stands in for ProfileStage while profiling is off, so an instrumented stage costs one method call and a flag check
+class NullStage:
+    def add(self, nbytes):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        pass
+
+_null_stage = NullStage()
+
+#Opt-in instrumentation of the pipeline. Each stage records its wall time, the bytes it produced, and the process and
+#thread it ran on. Threads share the module's profiler; worker processes profile into their own and hand their
+#records back with each job, so an Engine's work shows up here too. perf_counter is system wide on the platforms
+#multiprocessing supports, so times from different processes line up.
+class Profiler:
+    def __init__(self):
+        import os
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.records = []
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset) #forked workers must not report the parent's records
+    
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+    def reset(self):
+        self.lock = threading.Lock()
+        self.records = []
+    
+    """
+    A context manager timing the named stage, or one doing nothing when profiling is off.
+    """
+    def stage(self, name):
+        if not self.enabled:
+            return _null_stage
+        return ProfileStage(self, name)
+    def record(self, name, start, duration, nbytes=0):
+        import os
+        with self.lock:
+            self.records.append((name, start, duration, os.getpid(), threading.get_ident(), nbytes))
+    
+    #removes and returns everything recorded so far, as worker processes do to send their records back
+    def drain(self):
+        with self.lock:
+            (records, self.records) = (self.records, [])
+        return records
+    def merge(self, records):
+        if records:
+            with self.lock:
+                self.records.extend(records)
+    
+    """
+    Totals per stage: calls, total and mean wall time in milliseconds, the longest call, and bytes produced.
+    """
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+        stages = collections.OrderedDict()
+        for (name, start, duration, pid, tid, nbytes) in sorted(records, key=lambda record: record[1]):
+            stage = stages.setdefault(name, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "bytes": 0})
+            stage["calls"] += 1
+            stage["total_ms"] += duration * 1000.0
+            stage["max_ms"] = max(stage["max_ms"], duration * 1000.0)
+            stage["bytes"] += nbytes
+        for stage in stages.values():
+            stage["mean_ms"] = stage["total_ms"] / stage["calls"]
+        return stages
+    
+    #the records as Chrome trace events (chrome://tracing, Perfetto), timed in microseconds from the first record
+    def chromeTrace(self):
+        with self.lock:
+            records = list(self.records)
+        origin = min([record[1] for record in records] or [0.0])
+        events = []
+        for (name, start, duration, pid, tid, nbytes) in records:
+            events.append({"name": name, "ph": "X", "ts": (start - origin) * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid, "args": {"bytes": nbytes}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    
+    """
+    Writes the report to path, as "json" (the per stage summary) or "chrome" (a trace of every record).
+    """
+    def dump(self, path, format="json"):
+        import io
+        import json
+        if format == "json":
+            report = {"stages": self.summary()}
+        elif format == "chrome":
+            report = self.chromeTrace()
+        else:
+            raise ValueError("format must be json or chrome.")
+        with io.open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+profiler = Profiler()
+
+_module_available = {}
+
+#whether an optional module is installed, found once and without importing it (which for pygame or scipy takes far
+#longer than filtering a small image)
+def moduleAvailable(name):
+    if name not in _module_available:
+        import importlib.util
         try:
-            return openWithPygame(source)
+            _module_available[name] = importlib.util.find_spec(name) is not None
         except ImportError:
-            try:
-                return openWithPIL(source)
-            except ImportError:
-                raise ImportError("Could not import Pygame or PIL.")
-    elif base_type == Types.PIL:
-        return openWithPIL(source)
+            _module_available[name] = False #the parent package is missing
+    return _module_available[name]
+
+#the modules behind each image type, in order of preference: PIL imports in a fraction of the time pygame does
+type_modules = collections.OrderedDict([(Types.PIL, "PIL"), (Types.PYGAME, "pygame")])
+
+#the image types whose libraries are installed
+def availableTypes():
+    return [base_type for (base_type, module) in type_modules.items() if moduleAvailable(module)]
+
+#the image type open() and export() use when none is given
+def defaultType():
+    available = availableTypes()
+    if len(available) == 0:
+        raise ImportError("Could not import PIL or Pygame.")
+    return available[0]
+
+def open(source, base_type=None, dtype='float64'):
+    if base_type is None:
+        base_type = defaultType()
+    if base_type == Types.PIL:
+        return openWithPIL(source, dtype)
     elif base_type == Types.PYGAME:
-        return openWithPygame(source)
+        return openWithPygame(source, dtype)
     
     return None
 
 def export(matrix, base_type=None):
     if base_type is None:
-        try:
-            return exportToPIL(matrix)
-        except ImportError:
-            try:
-                return exportToPygame(matrix)
-            except ImportError:
-                raise ImportError("Could not import PIL or Pygame.")
-    elif base_type == Types.PIL:
+        base_type = defaultType()
+    if base_type == Types.PIL:
         return exportToPIL(matrix)
     elif base_type == Types.PYGAME:
         return exportToPygame(matrix)
     
     return None
 
-def openWithPIL(source):
+#the PIL modes whose pixels are used as they are: grayscale and RGB, each with or without alpha. Anything else (palette,
+#1-bit, 16 or 32 bit, CMYK...) is converted to the nearest of these first.
+pil_modes = ("L", "LA", "RGB", "RGBA")
+
+#the pixels of a PIL image as a uint8 array of one of pil_modes. Palette images are expanded to their colors, and 16 bit
+#grayscale is scaled down to 8 bits instead of being clipped at 255.
+def pilPixels(image):
+    if image.mode == "I" or image.mode.startswith("I;16"):
+        wide = numpy.array(image).astype(numpy.float64)
+        return numpy.clip(wide * (255.0 / 65535.0) + 0.5, 0, 255).astype('uint8')
+    if image.mode not in pil_modes:
+        if "A" in image.getbands() or "transparency" in image.info:
+            image = image.convert("RGBA")
+        elif len(image.getbands()) == 1 and image.mode != "P":
+            image = image.convert("L")
+        else:
+            image = image.convert("RGB")
+    return numpy.array(image, dtype='uint8')
+
+def openWithPIL(source, dtype='float64'):
     try:
         from PIL import Image
     except:
         raise ImportError("Could not import PIL.")
     else:
-        image = Image.open(source)
-        return BlurringMatrix(numpy.array(image, dtype='uint8'))
+        with profiler.stage("open.decode") as stage:
+            pixels = pilPixels(Image.open(source))
+            stage.add(pixels.nbytes)
+        with profiler.stage("open.convert") as stage:
+            matrix = BlurringMatrix(pixels, dtype=dtype)
+            stage.add(matrix.matrix.nbytes)
+        return matrix
 
-def openWithPygame(source):
+def openWithPygame(source, dtype='float64'):
     try:
         import pygame
     except:
         raise ImportError("Could not import Pygame.")
     else:
-        image = pygame.image.load(source)
-        pygame.surfarray.use_arraytype("numpy")
-        return BlurringMatrix(pygame.surfarray.array3d(image))
+        with profiler.stage("open.decode") as stage:
+            image = pygame.image.load(source)
+            pygame.surfarray.use_arraytype("numpy")
+            pixels = pygame.surfarray.array3d(image)
+            if image.get_flags() & pygame.SRCALPHA:
+                pixels = numpy.concatenate([pixels, pygame.surfarray.array_alpha(image)[:,:,numpy.newaxis]], axis=2)
+            stage.add(pixels.nbytes)
+        with profiler.stage("open.convert") as stage:
+            matrix = BlurringMatrix(pixels, dtype=dtype)
+            stage.add(matrix.matrix.nbytes)
+        return matrix
     
 def exportToPIL(matrix):
     try:
@@ -63,26 +241,601 @@ def exportToPIL(matrix):
     except:
         raise ImportError("Could not import PIL.")
     else:
-        return Image.fromarray(matrix.matrix.astype('uint8'))
+        with profiler.stage("export.astype") as stage:
+            pixels = matrix.matrix.astype('uint8')
+            if pixels.shape[2] == 1:
+                pixels = pixels[:,:,0] #PIL takes grayscale as 2-d
+            stage.add(pixels.nbytes)
+        with profiler.stage("export.encode"):
+            return Image.fromarray(pixels)
 
-def exportToPygame(matrix, surface=None):
+#with a surface and a Workspace to convert the pixels in, exporting allocates nothing. Grayscale is drawn as RGB, and
+#images with alpha get a per-pixel alpha surface.
+def exportToPygame(matrix, surface=None, workspace=None):
     try:
         import pygame
     except:
         raise ImportError("Could not import Pygame.")
     else:
-        if surface is None:
-            surface = pygame.Surface(matrix.matrix.shape[0:2])
-        pygame.surfarray.blit_array(surface, matrix.matrix.astype('uint8'))
+        with profiler.stage("export.astype") as stage:
+            if workspace is not None:
+                pixels = workspace.buffer("export", matrix.matrix.shape, "uint8")
+                numpy.copyto(pixels, matrix.matrix, casting="unsafe")
+            else:
+                pixels = matrix.matrix.astype('uint8')
+            stage.add(pixels.nbytes)
+        channels = pixels.shape[2]
+        with profiler.stage("export.encode"):
+            if surface is None:
+                surface = pygame.Surface(matrix.matrix.shape[0:2], pygame.SRCALPHA if channels in (2, 4) else 0)
+            color = pixels[:,:,:channels - 1] if channels in (2, 4) else pixels
+            if color.shape[2] == 1:
+                color = numpy.repeat(color, 3, axis=2)
+            pygame.surfarray.blit_array(surface, color)
+            if channels in (2, 4) and surface.get_flags() & pygame.SRCALPHA:
+                alpha = pygame.surfarray.pixels_alpha(surface)
+                alpha[...] = pixels[:,:,-1]
+                del alpha #unlocks the surface
         return surface
 
+#FFT backends. Each one wraps a real-to-complex 2d transform over two axes of an array; the half spectrum is
+#taken along the second of the two axes, so an (m, n, ...) image becomes an (m, n//2 + 1, ...) spectrum.
+#
+#Both take an optional out array to write the result into. overwrite=True lets irfft2 use the spectrum as scratch space.
+#With numpy 2's FFTs (which take out=) the numpy backend then runs without allocating; the others still allocate their
+#result internally and copy it into out.
+numpy_fft_out = int(numpy.__version__.split(".")[0]) >= 2
+
+#returns result, or copies it into out and returns out when one was given
+def intoOut(result, out):
+    if out is None:
+        return result
+    numpy.copyto(out, result)
+    return out
+
+class NumpyFFTBackend:
+    name = "numpy"
+    
+    def rfft2(self, array, axes=(0,1), out=None):
+        if numpy_fft_out:
+            return numpy.fft.rfft2(array, axes=axes, out=out)
+        return intoOut(numpy.fft.rfft2(array, axes=axes), out)
+    def irfft2(self, spectrum, shape, axes=(0,1), out=None, overwrite=False):
+        if not numpy_fft_out:
+            return intoOut(numpy.fft.irfft2(spectrum, s=shape, axes=axes), out)
+        if overwrite:
+            #irfft2 is an ifft down the first axis then an irfft along the second; done in place, the first needs no temporary
+            numpy.fft.ifft(spectrum, n=shape[0], axis=axes[0], out=spectrum)
+            return numpy.fft.irfft(spectrum, n=shape[1], axis=axes[1], out=out)
+        return numpy.fft.irfft2(spectrum, s=shape, axes=axes, out=out)
+    def singleThreaded(self):
+        return self #numpy's FFT only ever uses one thread
+
+class ScipyFFTBackend:
+    name = "scipy"
+    
+    def __init__(self, workers=-1):
+        try:
+            import scipy.fft
+        except:
+            raise ImportError("Could not import scipy.fft.")
+        self.fft = scipy.fft
+        self.workers = workers
+    def rfft2(self, array, axes=(0,1), out=None):
+        return intoOut(self.fft.rfft2(array, axes=axes, workers=self.workers), out)
+    def irfft2(self, spectrum, shape, axes=(0,1), out=None, overwrite=False):
+        return intoOut(self.fft.irfft2(spectrum, s=shape, axes=axes, workers=self.workers, overwrite_x=overwrite), out)
+    def singleThreaded(self):
+        return ScipyFFTBackend(workers=1)
+
+class PyFFTWBackend:
+    name = "pyfftw"
+    
+    def __init__(self, threads=None, wisdom_file=None):
+        try:
+            import pyfftw
+            import pyfftw.interfaces.numpy_fft
+        except:
+            raise ImportError("Could not import pyFFTW.")
+        import atexit
+        import io
+        import multiprocessing
+        import os
+        import pickle
+        self.pyfftw = pyfftw
+        self.fft = pyfftw.interfaces.numpy_fft
+        self.threads = threads if threads is not None else multiprocessing.cpu_count()
+        self.wisdom_file = wisdom_file if wisdom_file is not None else os.path.join(os.path.expanduser("~"), ".blur_fftw_wisdom")
+        pyfftw.interfaces.cache.enable()
+        try:
+            with io.open(self.wisdom_file, "rb") as f: #the module level open() shadows the builtin
+                pyfftw.import_wisdom(pickle.load(f))
+        except:
+            pass #no saved wisdom yet, plans will be measured as they are first used
+        atexit.register(self.saveWisdom)
+    def saveWisdom(self):
+        import io
+        import pickle
+        try:
+            with io.open(self.wisdom_file, "wb") as f:
+                pickle.dump(self.pyfftw.export_wisdom(), f)
+        except IOError:
+            pass
+    def rfft2(self, array, axes=(0,1), out=None):
+        return intoOut(self.fft.rfft2(array, axes=axes, threads=self.threads), out)
+    def irfft2(self, spectrum, shape, axes=(0,1), out=None, overwrite=False):
+        return intoOut(self.fft.irfft2(spectrum, s=shape, axes=axes, threads=self.threads, overwrite_input=overwrite), out)
+    def singleThreaded(self):
+        return PyFFTWBackend(threads=1, wisdom_file=self.wisdom_file)
+
+#Backends share one interface: rfft2 and irfft2 over the given axes, optionally into out, and singleThreaded(), the same
+#backend limited to one thread for running alongside others in worker processes.
+
+#backends in order of preference, fastest first
+fft_backends = [PyFFTWBackend, ScipyFFTBackend, NumpyFFTBackend]
+_fft_backend = None
+
+#picks the fastest importable FFT backend. If benchmark is set, every available backend is timed on a sample
+#image instead of trusting the preference order.
+def selectFFTBackend(benchmark=False, shape=(512, 512, 3)):
+    available = []
+    for backend_type in fft_backends:
+        try:
+            available.append(backend_type())
+        except ImportError:
+            pass
+        else:
+            if not benchmark:
+                break #the rest are never used, so they need not be imported
+    
+    chosen = available[0]
+    if benchmark and len(available) > 1:
+        sample = numpy.random.rand(*shape)
+        best = None
+        for backend in available:
+            backend.irfft2(backend.rfft2(sample), shape[:2]) #warm up any plans
+            start = time.time()
+            backend.irfft2(backend.rfft2(sample), shape[:2])
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+                chosen = backend
+    
+    setFFTBackend(chosen)
+    return chosen
+
+#sets the FFT backend used by all filtering, given either a backend instance or one of the backend names
+def setFFTBackend(backend):
+    global _fft_backend
+    if isinstance(backend, str):
+        for backend_type in fft_backends:
+            if backend_type.name == backend:
+                backend = backend_type()
+                break
+        else:
+            raise ValueError("Unknown FFT backend {0}.".format(backend))
+    _fft_backend = backend
+    return backend
+
+#below this many elements numpy's FFT is done before scipy.fft or pyfftw could even be imported, so until a backend has
+#been chosen, small transforms run on numpy's and leave the choice to the first large one
+small_fft_elements = 1 << 20
+_numpy_fft_backend = NumpyFFTBackend()
+
+#the FFT backend in use, selecting one if none has been chosen yet. elements is the size of the transform about to run.
+def getFFTBackend(elements=None):
+    if _fft_backend is None:
+        if elements is not None and elements < small_fft_elements:
+            return _numpy_fft_backend
+        selectFFTBackend()
+    return _fft_backend
+
+#reports the name of the FFT backend in use, selecting one if none has been chosen yet
+def fftBackendName():
+    return getFFTBackend().name
+
+#A bounded least-recently-used store for filter kernels and frequency grids. Everything it holds depends only on
+#the key (image shape, pixels_per_degree, cpd, dtype), so images of the same size never rebuild them.
+#Cached arrays are read-only since they are shared between callers.
+class KernelCache:
+    def __init__(self, max_bytes=128*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    #returns the entry for key, calling build() to create it on a miss
+    def get(self, key, build):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        
+        value = build()
+        value.flags.writeable = False
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.nbytes += value.nbytes
+                #always keep the newest entry, even if it alone is over the cap
+                while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                    (_, evicted) = self.entries.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return value
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.nbytes, "max_bytes": self.max_bytes}
+
+kernel_cache = KernelCache()
+
+#the squared distance from the origin of each point in the half-spectrum frequency grid of an m by n image
+def frequencyDistanceSquared(m, n, dtype="float64"):
+    def build():
+        (u, v) = halfMeshgridFrequencyMatrix(m, n)
+        return (u**2 + v**2).astype(dtype)
+    return kernel_cache.get(("distance", m, n, numpy.dtype(dtype).str), build)
+
+#the half-spectrum gaussian low pass multiplier for an m by n image, allowing a maximum of cpd cycles per degree
+def gaussianKernel(m, n, pixels_per_degree, cpd, dtype="float64"):
+    def build():
+        with profiler.stage("filter.kernel") as stage:
+            sigma = (pixels_per_degree * cpd) / 2.0
+            kernel = numpy.exp(-frequencyDistanceSquared(m, n, dtype) / (sigma**2)).astype(dtype, copy=False)
+            stage.add(kernel.nbytes)
+        return kernel
+    return kernel_cache.get(("gaussian", m, n, float(pixels_per_degree), float(cpd), numpy.dtype(dtype).str), build)
+
+#the radius in the frequency grid (cycles per image) that a filter at cpd cycles per degree is built around, on the
+#same scale as gaussianKernel's sigma so that every filter below agrees with lowPassFilter about what a cpd means
+def frequencyRadius(pixels_per_degree, cpd):
+    return (pixels_per_degree * cpd) / 2.0
+
+#Filters, specified in cycles per degree, for BlurringMatrix.filter() and filterBatch(). Each builds its half-spectrum
+#multiplier through the kernel cache. A filter that removes the mean (DC) of the image would leave it centred on 0, so
+#before clipping its output is shifted up by offset, mid-grey by default.
+class Filter:
+    name = None
+    passes_dc = True
+    
+    def __init__(self, offset=None):
+        self.offset = offset if offset is not None else (0.0 if self.passes_dc else 128.0)
+    #the values that, with name, identify this filter's output, for the disk cache
+    def params(self):
+        raise NotImplementedError("Filters must define params().")
+    def kernel(self, m, n, pixels_per_degree, dtype="float64"):
+        raise NotImplementedError("Filters must define kernel().")
+    def __repr__(self):
+        return "{0}{1}".format(type(self).__name__, self.params())
+
+class GaussianLowPass(Filter):
+    name = "lowpass"
+    
+    def __init__(self, cpd):
+        Filter.__init__(self)
+        self.cpd = float(cpd)
+    def params(self):
+        return (self.cpd,)
+    def kernel(self, m, n, pixels_per_degree, dtype="float64"):
+        return gaussianKernel(m, n, pixels_per_degree, self.cpd, dtype)
+
+class GaussianHighPass(Filter):
+    name = "highpass"
+    passes_dc = False
+    
+    def __init__(self, cpd, offset=None):
+        Filter.__init__(self, offset)
+        self.cpd = float(cpd)
+    def params(self):
+        return (self.cpd, self.offset)
+    def kernel(self, m, n, pixels_per_degree, dtype="float64"):
+        def build():
+            return 1 - gaussianKernel(m, n, pixels_per_degree, self.cpd, dtype)
+        return kernel_cache.get(("highpass", m, n, float(pixels_per_degree), self.cpd, numpy.dtype(dtype).str), build)
+
+"""
+The Butterworth filter 1/(1 + (D/r)**(2*order)), or its complement with high=True. It is flatter in the pass band and cuts off more sharply than the gaussian; its gain at cpd is exactly one half.
+"""
+class Butterworth(Filter):
+    name = "butterworth"
+    
+    def __init__(self, cpd, order=2, high=False, offset=None):
+        self.passes_dc = not high
+        Filter.__init__(self, offset)
+        self.cpd = float(cpd)
+        self.order = order
+        self.high = high
+    def params(self):
+        return (self.cpd, self.order, self.high, self.offset)
+    def kernel(self, m, n, pixels_per_degree, dtype="float64"):
+        def build():
+            ratio = frequencyDistanceSquared(m, n, dtype) / frequencyRadius(pixels_per_degree, self.cpd)**2
+            low = 1 / (1 + ratio**self.order)
+            return (1 - low if self.high else low).astype(dtype, copy=False)
+        return kernel_cache.get(("butterworth", m, n, float(pixels_per_degree), self.cpd, self.order, self.high, numpy.dtype(dtype).str), build)
+
+"""
+Passes frequencies between low_cpd and high_cpd, as the difference of the gaussian low passes at the two edges. Bands sharing edges add up exactly, so a bank of them (see octaveBank) decomposes an image.
+BandPass.octave(cpd) gives the band an octave wide centred, on a log scale, on cpd.
+"""
+class BandPass(Filter):
+    name = "bandpass"
+    passes_dc = False
+    
+    def __init__(self, low_cpd, high_cpd, offset=None):
+        if not 0 < low_cpd < high_cpd:
+            raise ValueError("A band pass needs 0 < low_cpd < high_cpd.")
+        Filter.__init__(self, offset)
+        self.low_cpd = float(low_cpd)
+        self.high_cpd = float(high_cpd)
+    @classmethod
+    def octave(cls, cpd, octaves=1.0, offset=None):
+        return cls(cpd * 2**(-octaves / 2.0), cpd * 2**(octaves / 2.0), offset)
+    def params(self):
+        return (self.low_cpd, self.high_cpd, self.offset)
+    def kernel(self, m, n, pixels_per_degree, dtype="float64"):
+        def build():
+            return gaussianKernel(m, n, pixels_per_degree, self.high_cpd, dtype) - gaussianKernel(m, n, pixels_per_degree, self.low_cpd, dtype)
+        return kernel_cache.get(("bandpass", m, n, float(pixels_per_degree), self.low_cpd, self.high_cpd, numpy.dtype(dtype).str), build)
+
+#A complete decomposition into bands octaves wide, centred from low_cpd up to high_cpd: a low pass below the first
+#band, the bands, and a high pass above the last. Unclipped (see BlurringMatrix.filterBatch) the outputs sum to the image.
+def octaveBank(low_cpd, high_cpd, octaves=1.0):
+    count = int(math.floor(math.log(float(high_cpd) / low_cpd, 2) / octaves + 1e-9)) + 1
+    edges = [low_cpd * 2**((k - 0.5) * octaves) for k in range(count + 1)]
+    bank = [GaussianLowPass(edges[0])]
+    bank += [BandPass(edges[k], edges[k + 1]) for k in range(count)]
+    bank.append(GaussianHighPass(edges[-1]))
+    return bank
+
+#turns a filter, a cpd, or an iterable (or array) of either into an iterator over filters. Plain numbers are gaussian low passes.
+def iterFilters(filters):
+    if isinstance(filters, Filter):
+        return iter([filters])
+    return (spec if isinstance(spec, Filter) else GaussianLowPass(spec) for spec in iterCutoffs(filters))
+
+#the symmetric 1-d spatial kernel equivalent, along one axis of the given length, to the gaussian low pass multiplier.
+#The multiplier is separable, exp(-(u**2 + v**2)/sigma**2) = exp(-u**2/sigma**2) * exp(-v**2/sigma**2), so filtering
+#each axis with its inverse transform gives the same filter as the frequency domain path. Only taps[0] (the centre)
+#and the positive half are returned, cut off where the remaining weight drops below tolerance.
+def spatialKernel(length, pixels_per_degree, cpd, dtype="float64", tolerance=1e-4):
+    def build():
+        sigma = (pixels_per_degree * cpd) / 2.0
+        k = numpy.arange(0, length//2 + 1)
+        h = numpy.fft.irfft(numpy.exp(-(k**2) / (sigma**2)), n=length)[:length//2 + 1]
+        weight = numpy.abs(h)
+        weight[1:] *= 2 #each tap past the centre is used on both sides
+        remaining = numpy.append(numpy.cumsum(weight[::-1])[::-1][1:], 0)
+        radius = int(numpy.argmax(remaining <= tolerance))
+        taps = h[:radius + 1]
+        return (taps / (taps[0] + 2*taps[1:].sum())).astype(dtype) #renormalize so flat areas keep their value
+    return kernel_cache.get(("spatial", length, float(pixels_per_degree), float(cpd), float(tolerance), numpy.dtype(dtype).str), build)
+
+#Reusable scratch buffers for filtering many same-shaped images, so that after the first call no large array is
+#allocated. Buffers are handed out by name and only reallocated when the shape or type asked for changes. The
+#forward spectrum buffer is lent to one matrix at a time: computing another matrix's spectrum into it takes it back
+#from the previous one. A workspace is not thread safe; give each thread its own.
+class Workspace:
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+        self.spectrum_owner = None
+    
+    def buffer(self, name, shape, dtype):
+        shape = tuple(shape)
+        dtype = numpy.dtype(dtype)
+        array = self.buffers.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = numpy.empty(shape, dtype)
+            self.buffers[name] = array
+            self.allocations += 1
+        return array
+    
+    #the matrix's spectrum, forward transformed into this workspace unless the matrix already holds one
+    def spectrum(self, matrix):
+        import weakref
+        if matrix._spectrum is not None:
+            return matrix._spectrum
+        (cols, rows, channels) = matrix.matrix.shape
+        spectrum = self.buffer("spectrum", (channels, cols, rows//2 + 1), complexType(matrix.matrix.dtype))
+        previous = self.spectrum_owner() if self.spectrum_owner is not None else None
+        if previous is not None and previous._spectrum is spectrum:
+            previous.release_spectrum()
+        with profiler.stage("filter.forward_fft"):
+            getFFTBackend(spectrum.size).rfft2(matrix.matrix.transpose(2,0,1), axes=(1,2), out=spectrum)
+        matrix._spectrum = spectrum
+        self.spectrum_owner = weakref.ref(matrix)
+        return spectrum
+    
+    def stats(self):
+        return {"buffers": len(self.buffers), "bytes": sum(array.nbytes for array in self.buffers.values()), "allocations": self.allocations}
+
+_ndimage = None
+
+#scipy.ndimage if it can be imported, otherwise False
+def getNdimage():
+    global _ndimage
+    if _ndimage is None:
+        try:
+            import scipy.ndimage
+            _ndimage = scipy.ndimage
+        except ImportError:
+            _ndimage = False
+    return _ndimage
+
+#convolves one axis of an array with symmetric taps (as returned by spatialKernel). At its edges the array is
+#mirrored with mode="reflect", or wrapped around like the FFT does with mode="wrap". Uses scipy.ndimage when
+#available and a loop over the taps otherwise.
+convolve_modes = {"reflect": "symmetric", "wrap": "wrap"} #ndimage's names and numpy.pad's
+def convolveAxis(array, taps, axis, mode="reflect"):
+    if mode not in convolve_modes:
+        raise ValueError("mode must be one of {0}.".format(", ".join(convolve_modes)))
+    radius = len(taps) - 1
+    if radius == 0:
+        return array * taps[0]
+    ndimage = getNdimage()
+    if ndimage:
+        return ndimage.correlate1d(array, numpy.concatenate((taps[:0:-1], taps)), axis=axis, mode=mode)
+    padding = [(0, 0)] * array.ndim
+    padding[axis] = (radius, radius)
+    padded = numpy.pad(array, padding, mode=convolve_modes[mode])
+    length = array.shape[axis]
+    
+    def shifted(offset):
+        index = [slice(None)] * array.ndim
+        index[axis] = slice(radius + offset, radius + offset + length)
+        return padded[tuple(index)]
+    
+    out = shifted(0) * taps[0]
+    scratch = numpy.empty_like(out)
+    for k in range(1, radius + 1):
+        numpy.add(shifted(k), shifted(-k), out=scratch)
+        scratch *= taps[k]
+        out += scratch
+    return out
+
+#the spatial domain counterpart of the gaussian low pass: a separable convolution over the first two axes of matrix.
+#It wraps around at the edges by default, so that it computes the same filter as the FFT (up to spatialKernel's tolerance).
+def spatialLowPass(matrix, pixels_per_degree, cpd, mode="wrap"):
+    (cols, rows) = matrix.shape[:2]
+    out = convolveAxis(matrix, spatialKernel(cols, pixels_per_degree, cpd, matrix.dtype), 0, mode)
+    return convolveAxis(out, spatialKernel(rows, pixels_per_degree, cpd, matrix.dtype), 1, mode)
+
+#Rough per-element costs, in seconds, used to choose between the FFT and spatial paths, measured with the scipy FFT
+#backend on images from 256x256 to 2048x2048. Filtering by FFT costs about fft_cost * elements * log2(pixels) for each
+#of the forward and inverse transforms, and by convolution about pass_cost * elements for each of the two axes plus
+#tap_cost * elements for each tap of spatialKernel on each axis, depending on whether scipy.ndimage is doing it.
+fft_cost = 1.4e-9
+pass_cost = {"ndimage": 2.0e-8, "numpy": 5.0e-9}
+tap_cost = {"ndimage": 1.2e-9, "numpy": 4.2e-9}
+filter_methods = ("auto", "fft", "spatial")
+
+#picks "fft" or "spatial" for filtering an image of the given shape, whichever the cost model says is cheaper.
+#Both transforms are always counted, so the choice depends only on the shape and the filter, never on what a matrix
+#happens to have cached.
+def chooseFilterMethod(shape, pixels_per_degree, cpd, dtype="float64"):
+    (cols, rows) = shape[:2]
+    elements = float(numpy.prod(shape))
+    fft = fft_cost * elements * math.log(max(cols * rows, 2), 2) * 2
+    taps = len(spatialKernel(cols, pixels_per_degree, cpd, dtype)) + len(spatialKernel(rows, pixels_per_degree, cpd, dtype))
+    implementation = "ndimage" if moduleAvailable("scipy.ndimage") else "numpy"
+    spatial = elements * (pass_cost[implementation] * 2 + tap_cost[implementation] * taps)
+    return "spatial" if spatial < fft else "fft"
+
+#the luma weights of RGB (ITU-R BT.601, as JPEG's YCbCr uses), for filtering luminance alone
+luma_weights = numpy.array([0.299, 0.587, 0.114])
+alpha_modes = ("pass", "filter")
+
 class BlurringMatrix:
-    matrix = None
     pixels_per_degree = None
     
-    def __init__(self, matrix, pixels_per_degree=None):
-        self.matrix = matrix.astype('float64')
+    def __init__(self, matrix, pixels_per_degree=None, dtype='float64'):
+        if matrix.ndim == 2:
+            matrix = matrix[:,:,numpy.newaxis] #grayscale, kept as a single channel
+        self.matrix = matrix.astype(checkFloatType(dtype), order='C')
         self.pixels_per_degree = pixels_per_degree
+    
+    """
+    The image data. Assigning a new matrix drops the cached spectrum and hash. It is held as a read-only view, so that editing it in place, which would leave them stale, raises instead;
+    assign an edited copy, or use copyInto() to overwrite it.
+    """
+    @property
+    def matrix(self):
+        return self._matrix
+    @matrix.setter
+    def matrix(self, value):
+        self._matrix = value.view()
+        self._matrix.flags.writeable = False
+        self._spectrum = None
+        self._hash = None
+        self._planes = {}
+    
+    """
+    The forward real-input FFT of each channel of the matrix, laid out channel first as (channels, m, n//2 + 1) so the transformed axes are contiguous.
+    It is computed on first use and kept until the matrix changes or release_spectrum() is called.
+    """
+    def spectrum(self):
+        if self._spectrum is None:
+            cache = getDiskCache()
+            if cache and cache.store_spectra:
+                key = cache.spectrumKey(self)
+                self._spectrum = cache.load(key)
+            if self._spectrum is None:
+                with profiler.stage("filter.forward_fft") as stage:
+                    spectrum = getFFTBackend(self._matrix.size).rfft2(self._matrix.transpose(2,0,1), axes=(1,2))
+                    self._spectrum = spectrum.astype(complexType(self._matrix.dtype), copy=False)
+                    stage.add(self._spectrum.nbytes)
+                if cache and cache.store_spectra:
+                    cache.store(key, self._spectrum)
+        return self._spectrum
+    def release_spectrum(self):
+        self._spectrum = None
+        self._hash = None
+        self._planes = {}
+    
+    """
+    The planes filtering actually transforms, as a BlurringMatrix, and a function combine(result, clip) turning a filtered result of them into one for this matrix; combine is None when that is this matrix itself.
+    Images with alpha (2 or 4 channels) leave alpha out unless alpha="filter", and with luminance set an RGB image is reduced to its luma plane, which after filtering replaces the original luma with chroma
+    unchanged. Since every channel of the inverse YCbCr transform is Y plus a mix of chroma, that is the original RGB shifted by the change in Y. The planes are kept until the matrix changes.
+    """
+    def filterPlanes(self, alpha="pass", luminance=False):
+        if alpha not in alpha_modes:
+            raise ValueError("alpha must be one of {0}.".format(", ".join(alpha_modes)))
+        channels = self.matrix.shape[2]
+        if channels not in (1, 2, 3, 4):
+            raise NotImplementedError("Filtering can only operate on 1 to 4 channel images. Input has {0} channels.".format(channels))
+        has_alpha = channels in (2, 4)
+        color = channels - 1 if has_alpha else channels
+        luminance = luminance and color == 3
+        pass_alpha = has_alpha and alpha == "pass"
+        if not luminance and not pass_alpha:
+            return (self, None)
+        
+        key = (alpha, luminance)
+        if key not in self._planes:
+            if luminance:
+                planes = [numpy.dot(self.matrix[:,:,:3], luma_weights.astype(self.matrix.dtype))[:,:,numpy.newaxis]]
+            else:
+                planes = [self.matrix[:,:,:color]]
+            if has_alpha and not pass_alpha:
+                planes.append(self.matrix[:,:,color:])
+            self._planes[key] = BlurringMatrix(numpy.concatenate(planes, axis=2), dtype=self.matrix.dtype)
+        source = self._planes[key]
+        source.pixels_per_degree = self.pixels_per_degree
+        
+        def combine(result, clip=True):
+            filtered = result.matrix
+            if luminance:
+                out = self.matrix[:,:,:3] + (filtered[:,:,:1] - source.matrix[:,:,:1])
+                if clip:
+                    numpy.clip(out, 0, 255, out=out)
+                used = 1
+            else:
+                out = filtered[:,:,:color]
+                used = color
+            if has_alpha:
+                out = numpy.concatenate([out, self.matrix[:,:,color:] if pass_alpha else filtered[:,:,used:]], axis=2)
+            return BlurringMatrix(out, self.pixels_per_degree, filtered.dtype)
+        return (source, combine)
+    
+    """
+    A hash of the pixel data (with its shape and type), computed once until the matrix is reassigned or overwritten by copyInto(). Used to key the disk cache.
+    """
+    def sourceHash(self):
+        if self._hash is None:
+            import hashlib
+            digest = hashlib.sha256(repr((self._matrix.shape, self._matrix.dtype.str)).encode("ascii"))
+            digest.update(numpy.ascontiguousarray(self._matrix).data)
+            self._hash = digest.hexdigest()
+        return self._hash
     def calcPixelsPerDegree(self, resolution, display_size, visual_distance):
         pixel_size = (float(display_size[0]) / resolution[0], float(display_size[1]) / resolution[1])
         double_vdist = 2.0 * visual_distance
@@ -95,95 +848,898 @@ class BlurringMatrix:
         
         return self #chainable method
     def copy(self):
-        return BlurringMatrix(self.matrix.copy(), self.pixels_per_degree)
+        return BlurringMatrix(self.matrix, self.pixels_per_degree, self.matrix.dtype)
     def resolutionIsCalculated(self):
         return (self.pixels_per_degree is not None)
     
     """
-    Applies a low pass blurring filter to each cpd in the given list, allowing a maximum of the given cycles per degree of visual angle.
+    Applies each filter in the given iterable (or a single Filter) and yields the results lazily, in the same order. Plain numbers stand for GaussianLowPass filters at that cpd.
+    Filters are applied chunk_size at a time from the one cached spectrum, with one stacked inverse FFT per chunk; larger chunks are faster but peak memory grows with them.
+    dtype selects the precision the filter runs in (see float_types); by default it is that of this matrix, and results keep it.
+    method is "fft", "spatial" (the same filter as a separable convolution, see spatialLowPass) or "auto", which picks whichever of the two chooseFilterMethod() estimates is cheaper for the image's shape and the filter. Only gaussian low passes can be spatial.
+    cache is a DiskCache to look results up in and store them to; by default that is the one set with setDiskCache(), if any, and False disables it.
+    With clip=False results are neither offset nor clipped to 0-255, so signed band pass outputs are kept as they are.
+    Grayscale, RGB and either with alpha are supported. alpha="pass" copies alpha through untouched and "filter" filters it like any other channel.
+    luminance=True filters only the luma of an RGB image, keeping its chroma (see filterPlanes), for a third of the FFT work.
     """
-    def lowPassFilterBatch(self, cyclesPerDegree, concurrent=False, supress=False):
+    def filterBatch(self, filters, concurrent=False, supress=False, chunk_size=4, dtype=None, method="fft", cache=None, clip=True, alpha="pass", luminance=False):
         if(not self.resolutionIsCalculated()):
-            raise RuntimeError("The pixels_per_degree must be set before a low-pass filter can be applied.")
+            raise RuntimeError("The pixels_per_degree must be set before a filter can be applied.")
         
-        if(self.matrix.shape[2] != 3):
-            raise NotImplementedError("Filtering can only operate on RGB images (3-channel) at this time. Input has {0} channels.".format(self.matrix.shape[2]))
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
         
-        cols, rows = self.matrix.shape[:2]
-        (u, v) = meshgridFrequencyMatrix(cols, rows)
-        D = numpy.sqrt(u**2 + v**2)
-        fftd = numpy.fft.fft2(self.matrix, axes=(0,1))
-        
-        if type(cyclesPerDegree) == int:
-            cyclesPerDegree = [cyclesPerDegree]
-        for cpd in cyclesPerDegree:
-            sigma = (self.pixels_per_degree * cpd) / 2.0
-            f = numpy.exp(-(D**2)/((sigma**2)))
-            out = None
-            if not concurrent:
-                fn = numpy.reshape(numpy.tile(f, 3), (cols, rows, 3), 'F')
-                out = numpy.real(numpy.fft.ifft2(fftd * fn, axes=(0,1)))
-            else: #futures exists!
-                try:
-                    import concurrent.futures
-                except:
-                    if supress:
-                        fn = numpy.reshape(numpy.tile(f, 3), (cols, rows, 3), 'F')
-                        out = numpy.real(numpy.fft.ifft2(fftd * fn, axes=(0,1)))
-                    else:
-                        raise ImportError("Could not import the Python3 concurrency library. Set concurrent=False.")
-                else:
-                    with concurrent.futures.ProcessPoolExecutor() as e:
-                        mapper = e.map(filterAndInvert, [self.matrix[:,:,0], self.matrix[:,:,1], self.matrix[:,:,2]], [f, f, f])
-                        out = numpy.concatenate((mapper.__next__(),mapper.__next__(), mapper.__next__()), axis=2)
-                
-            yield BlurringMatrix(numpy.clip(out, 0, 255), self.pixels_per_degree)
-
+        if method not in filter_methods:
+            raise ValueError("method must be one of {0}.".format(", ".join(filter_methods)))
+        
+        if dtype is not None and checkFloatType(dtype) != self.matrix.dtype:
+            source = BlurringMatrix(self.matrix, self.pixels_per_degree, dtype)
+            for result in source.filterBatch(filters, concurrent, supress, chunk_size, method=method, cache=cache, clip=clip, alpha=alpha, luminance=luminance):
+                yield result
+            return
+        dtype = self.matrix.dtype
+        
+        (source, combine) = self.filterPlanes(alpha, luminance)
+        if combine is not None:
+            for result in source.filterBatch(filters, concurrent, supress, chunk_size, method=method, cache=cache, clip=clip, alpha="filter"):
+                yield combine(result, clip)
+            return
+        
+        engine = None
+        if concurrent:
+            try:
+                engine = concurrent if isinstance(concurrent, Engine) else defaultEngine()
+            except ImportError:
+                if not supress:
+                    raise ImportError("Could not import the Python3 concurrency libraries. Set concurrent=False.")
+        
+        if method == "spatial":
+            engine = None
+        if cache is None:
+            cache = getDiskCache()
+        
+        specs = iterFilters(filters)
+        while True:
+            chunk = list(itertools.islice(specs, chunk_size))
+            if len(chunk) == 0:
+                break
+            
+            if engine is not None:
+                methods = ["fft"] * len(chunk)
+            else:
+                methods = [self.filterMethod(spec, method) for spec in chunk]
+            
+            results = [None] * len(chunk)
+            if cache:
+                for index in range(len(chunk)):
+                    with profiler.stage("filter.cache_load"):
+                        stored = cache.load(cache.filteredKey(self, chunk[index], methods[index], clip))
+                    if stored is not None:
+                        results[index] = BlurringMatrix(stored, self.pixels_per_degree, dtype)
+            
+            missing = [index for index in range(len(chunk)) if results[index] is None]
+            if len(missing) > 0:
+                computed = self.filterChunk([chunk[index] for index in missing], [methods[index] for index in missing], engine, clip)
+                for (index, result) in zip(missing, computed):
+                    results[index] = result
+                    if cache:
+                        with profiler.stage("filter.cache_store") as stage:
+                            cache.store(cache.filteredKey(self, chunk[index], methods[index], clip), result.matrix)
+                            stage.add(result.matrix.nbytes)
+            
+            for result in results:
+                yield result
+            del results
+    
     """
-    Applies a low pass blurring filter, allowing a maximum of the given cycles per degree of visual angle.
+    Applies a low pass blurring filter to each cpd in the given iterable (or array, or single value), allowing a maximum of the given cycles per degree of visual angle.
+    The same as filterBatch with a GaussianLowPass for each cpd.
     """
-    def lowPassFilter(self, cyclesPerDegree, concurrent=False, supress=False):
-        if(not self.resolutionIsCalculated()):
-            raise RuntimeError("The pixels_per_degree must be set before a low-pass filter can be applied.")
-        
-        if(self.matrix.shape[2] != 3):
-            raise NotImplementedError("Filtering can only operate on RGB images (3-channel) at this time. Input has {0} channels.".format(self.matrix.shape[2]))
+    def lowPassFilterBatch(self, cyclesPerDegree, concurrent=False, supress=False, chunk_size=4, dtype=None, method="fft", cache=None, alpha="pass", luminance=False):
+        return self.filterBatch((GaussianLowPass(cpd) for cpd in iterCutoffs(cyclesPerDegree)), concurrent, supress, chunk_size, dtype, method, cache, alpha=alpha, luminance=luminance)
+    
+    """
+    Splits the image into bands octaves wide from low_cpd to high_cpd, plus the low and high frequencies either side, all from one forward FFT (see octaveBank).
+    By default the results are unclipped, so they sum back to the image; pass clip=True for viewable, mid-grey centred bands.
+    """
+    def decompose(self, low_cpd, high_cpd, octaves=1.0, clip=False, chunk_size=4, dtype=None, cache=None, alpha="pass", luminance=False):
+        return self.filterBatch(octaveBank(low_cpd, high_cpd, octaves), chunk_size=chunk_size, dtype=dtype, method="fft", cache=cache, clip=clip, alpha=alpha, luminance=luminance)
+    
+    #applies the filters with the given methods, through the engine if there is one, returning a list of results
+    def filterChunk(self, filters, methods, engine=None, clip=True):
+        if engine is not None:
+            return engine.filterPlanesMany([self], filters, clip)[0]
         
         cols, rows = self.matrix.shape[:2]
-        (u, v) = meshgridFrequencyMatrix(cols, rows)
-        D = numpy.sqrt(u**2 + v**2)
-        fftd = numpy.fft.fft2(self.matrix, axes=(0,1))
-        
-        sigma = (self.pixels_per_degree * cyclesPerDegree) / 2.0
-        f = numpy.exp(-(D**2)/((sigma**2)))
+        dtype = self.matrix.dtype
+        transformed = [spec for (spec, chosen) in zip(filters, methods) if chosen == "fft"]
         out = None
-        if not concurrent:
-            fn = numpy.reshape(numpy.tile(f, 3), (cols, rows, 3), 'F')
-            out = numpy.real(numpy.fft.ifft2(fftd * fn, axes=(0,1)))
-        else: #futures exists!
-            try:
-                import concurrent.futures
-            except:
-                if supress:
-                    fn = numpy.reshape(numpy.tile(f, 3), (cols, rows, 3), 'F')
-                    out = numpy.real(numpy.fft.ifft2(fftd * fn, axes=(0,1)))
-                else:
-                    raise ImportError("Could not import the Python3 concurrency library. Set concurrent=False.")
+        if len(transformed) > 0:
+            fftd = self.spectrum()
+            f = numpy.stack([spec.kernel(cols, rows, self.pixels_per_degree, dtype) for spec in transformed])
+            with profiler.stage("filter.inverse_fft") as stage:
+                out = getFFTBackend(self.matrix.size * len(transformed)).irfft2(fftd[numpy.newaxis] * f[:,numpy.newaxis], (cols, rows), axes=(2,3), overwrite=True)
+                stage.add(out.nbytes)
+            if clip:
+                with profiler.stage("filter.clip"):
+                    for (index, spec) in enumerate(transformed):
+                        if spec.offset != 0:
+                            out[index] += spec.offset
+                    numpy.clip(out, 0, 255, out=out)
+        
+        results = []
+        index = 0
+        for (spec, chosen) in zip(filters, methods):
+            if chosen == "fft":
+                results.append(BlurringMatrix(out[index].transpose(1,2,0), self.pixels_per_degree, dtype))
+                index += 1
             else:
-                with concurrent.futures.ProcessPoolExecutor() as e:
-                    mapper = e.map(filterAndInvert, [self.matrix[:,:,0], self.matrix[:,:,1], self.matrix[:,:,2]], [f, f, f])
-                    out = numpy.concatenate((mapper.__next__(),mapper.__next__(), mapper.__next__()), axis=2)
+                with profiler.stage("filter.spatial") as stage:
+                    filtered = spatialLowPass(self.matrix, self.pixels_per_degree, spec.cpd)
+                    results.append(BlurringMatrix(numpy.clip(filtered, 0, 255, out=filtered) if clip else filtered, self.pixels_per_degree, dtype))
+                    stage.add(results[-1].matrix.nbytes)
+        return results
+    
+    """
+    Returns the method ("fft" or "spatial") that applying the filter (or low pass at the given cpd) would use. With method="auto" that is whichever chooseFilterMethod() estimates is cheaper.
+    """
+    def filterMethod(self, spec, method="fft"):
+        if not isinstance(spec, Filter):
+            spec = GaussianLowPass(spec)
+        if not isinstance(spec, GaussianLowPass):
+            if method == "spatial":
+                raise ValueError("Only gaussian low pass filters can be applied spatially.")
+            return "fft"
+        if method != "auto":
+            return method
+        return chooseFilterMethod(self.matrix.shape, self.pixels_per_degree, spec.cpd, self.matrix.dtype)
+
+    """
+    Applies one filter (or a low pass at the given cpd); see filterBatch.
+    If concurrent is set the work is spread over the default Engine's worker processes; an Engine instance can also be passed to use that one instead.
+    out is an existing BlurringMatrix of the same shape and type to write the result into. Given a Workspace as well, the frequency domain filter runs in its reusable buffers
+    (see filterInto), so filtering same-shaped images over and over makes no large allocations after the first call.
+    """
+    def filter(self, spec, concurrent=False, supress=False, dtype=None, method="fft", cache=None, out=None, workspace=None, clip=True, alpha="pass", luminance=False):
+        with profiler.stage("filter"):
+            spec = next(iterFilters(spec))
+            (source, combine) = self.filterPlanes(alpha, luminance)
+            if combine is not None:
+                result = combine(source.filter(spec, concurrent, supress, dtype, method, cache, None, workspace, clip, alpha="filter"), clip)
+                return result if out is None else self.copyInto(result.matrix, out)
+            if cache is None:
+                cache = getDiskCache()
+            if workspace is not None and not concurrent and not cache and (dtype is None or checkFloatType(dtype) == self.matrix.dtype) and self.filterMethod(spec, method) == "fft":
+                return self.filterInto(spec, workspace, out, clip)
+            result = next(self.filterBatch([spec], concurrent=concurrent, supress=supress, dtype=dtype, method=method, cache=cache, clip=clip, alpha="filter"))
+            if out is None:
+                return result
+            return self.copyInto(result.matrix, out)
+
+    """
+    Applies a low pass blurring filter, allowing a maximum of the given cycles per degree of visual angle. The same as filter(GaussianLowPass(cyclesPerDegree), ...).
+    """
+    def lowPassFilter(self, cyclesPerDegree, concurrent=False, supress=False, dtype=None, method="fft", cache=None, out=None, workspace=None, alpha="pass", luminance=False):
+        return self.filter(GaussianLowPass(cyclesPerDegree), concurrent, supress, dtype, method, cache, out, workspace, alpha=alpha, luminance=luminance)
+    
+    """
+    A frequency domain filter, run entirely in the workspace's buffers and written into out. Apart from the result (when out is None)
+    and the first use of a workspace or kernel, nothing large is allocated; see the notes on the FFT backends.
+    """
+    def filterInto(self, spec, workspace, out=None, clip=True):
+        if(not self.resolutionIsCalculated()):
+            raise RuntimeError("The pixels_per_degree must be set before a filter can be applied.")
+        (cols, rows, channels) = self.matrix.shape
+        dtype = self.matrix.dtype
+        spectrum = workspace.spectrum(self)
+        f = spec.kernel(cols, rows, self.pixels_per_degree, dtype)
+        product = workspace.buffer("product", spectrum.shape, spectrum.dtype)
+        planes = workspace.buffer("planes", (channels, cols, rows), dtype)
+        with profiler.stage("filter.inverse_fft") as stage:
+            numpy.multiply(spectrum, f, out=product)
+            getFFTBackend(planes.size).irfft2(product, (cols, rows), axes=(1,2), out=planes, overwrite=True)
+            stage.add(planes.nbytes)
+        if clip:
+            with profiler.stage("filter.clip"):
+                if spec.offset != 0:
+                    planes += spec.offset
+                numpy.clip(planes, 0, 255, out=planes)
+        if out is None:
+            return BlurringMatrix(planes.transpose(1,2,0), self.pixels_per_degree, dtype)
+        return self.copyInto(planes.transpose(1,2,0), out)
+    
+    #writes filtered pixels into the existing BlurringMatrix out, which must match this one's shape and type
+    def copyInto(self, pixels, out):
+        if out.matrix.shape != pixels.shape or out.matrix.dtype != pixels.dtype:
+            raise ValueError("out must be a {0} matrix of shape {1}.".format(pixels.dtype.name, pixels.shape))
+        out._matrix.flags.writeable = True
+        try:
+            numpy.copyto(out._matrix, pixels)
+        finally:
+            out._matrix.flags.writeable = False
+        out.release_spectrum()
+        out.pixels_per_degree = self.pixels_per_degree
+        return out
+
+
+#turns a single cutoff, an iterable of cutoffs or an array of cutoffs into an iterator over single values
+def iterCutoffs(cyclesPerDegree):
+    if isinstance(cyclesPerDegree, numpy.ndarray):
+        return iter(cyclesPerDegree.ravel().tolist())
+    if numpy.isscalar(cyclesPerDegree):
+        return iter([cyclesPerDegree])
+    return iter(cyclesPerDegree)
+
+#An array living in a multiprocessing.shared_memory block. Worker processes attach to it by name, so only the
+#descriptor (name, shape, dtype) is ever pickled.
+class SharedArray:
+    def __init__(self, shape, dtype, name=None):
+        from multiprocessing import shared_memory
+        dtype = numpy.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(1, int(numpy.prod(shape)) * dtype.itemsize)
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.array = numpy.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+    
+    @classmethod
+    def attach(cls, descriptor):
+        (name, shape, dtype) = descriptor
+        return cls(shape, dtype, name)
+    def descriptor(self):
+        return (self.memory.name, self.array.shape, self.array.dtype.str)
+    def close(self):
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+#forward transforms one channel of a shared image into the matching plane of a shared spectrum. Like filterAndInvert,
+#it returns whatever the worker's profiler recorded, which is nothing unless profile is set.
+def transformPlane(image, spectrum, channel, profile=False):
+    profiler.enabled = profile
+    image = SharedArray.attach(image)
+    spectrum = SharedArray.attach(spectrum)
+    try:
+        with profiler.stage("filter.forward_fft") as stage:
+            spectrum.array[channel] = getFFTBackend().rfft2(image.array[:,:,channel])
+            stage.add(spectrum.array[channel].nbytes)
+    finally:
+        image.close()
+        spectrum.close()
+    return profiler.drain()
+
+#applies a filter to one channel of a shared spectrum, writing the (offset and clipped, if clip is set) result into the
+#same channel of a shared output image. The kernel is built in the worker, where the kernel cache persists across calls.
+def filterAndInvert(spectrum, out, channel, pixels_per_degree, spec, clip=True, profile=False):
+    profiler.enabled = profile
+    spectrum = SharedArray.attach(spectrum)
+    out = SharedArray.attach(out)
+    try:
+        cols, rows = out.array.shape[:2]
+        f = spec.kernel(cols, rows, pixels_per_degree, out.array.dtype)
+        with profiler.stage("filter.inverse_fft") as stage:
+            ifftd = getFFTBackend().irfft2(spectrum.array[channel] * f, (cols, rows))
+            stage.add(ifftd.nbytes)
+        if clip:
+            with profiler.stage("filter.clip"):
+                if spec.offset != 0:
+                    ifftd += spec.offset
+                numpy.clip(ifftd, 0, 255, out=ifftd)
+        out.array[:,:,channel] = ifftd
+    finally:
+        spectrum.close()
+        out.close()
+    return profiler.drain()
+
+#runs in each Engine worker as it starts. The workers already run side by side, one per core by default, so each one's
+#FFTs are held to a single thread rather than every worker starting a thread per core.
+def startEngineWorker():
+    setFFTBackend(getFFTBackend().singleThreaded())
+
+#A persistent pool of worker processes for filtering, meant to be created once and reused. Every channel of every
+#(image, cutoff) pair is an independent job, so the work spreads across images and cutoffs rather than only across
+#the 3 channels of one image. Images, spectra and results are exchanged through shared memory.
+class Engine:
+    def __init__(self, workers=None):
+        try:
+            import concurrent.futures
+            from multiprocessing import shared_memory
+        except:
+            raise ImportError("Could not import the Python3 concurrency libraries.")
+        self.workers = workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=startEngineWorker)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+    
+    """
+    Applies every filter to every matrix. Returns a list with one entry per matrix, each a list of BlurringMatrix results in filter order.
+    Spectra computed along the way are kept on the source matrices, as with BlurringMatrix.spectrum(). alpha and luminance are as for BlurringMatrix.filterBatch().
+    """
+    def filterMany(self, matrices, filters, clip=True, alpha="pass", luminance=False):
+        if self.executor is None:
+            raise RuntimeError("The engine has been closed.")
+        specs = list(iterFilters(filters))
+        for matrix in matrices:
+            if(not matrix.resolutionIsCalculated()):
+                raise RuntimeError("The pixels_per_degree must be set before a filter can be applied.")
+        planes = [matrix.filterPlanes(alpha, luminance) for matrix in matrices]
+        results = self.filterPlanesMany([source for (source, _) in planes], specs, clip)
+        return [row if combine is None else [combine(result, clip) for result in row] for ((_, combine), row) in zip(planes, results)]
+    
+    #filterMany for matrices whose every channel is to be filtered
+    def filterPlanesMany(self, matrices, specs, clip=True):
+        buffers = []
+        try:
+            #forward transforms, skipped for any matrix that already holds its spectrum
+            spectra = []
+            pending = []
+            for matrix in matrices:
+                (cols, rows, channels) = matrix.matrix.shape
+                spectrum = SharedArray((channels, cols, rows//2 + 1), complexType(matrix.matrix.dtype))
+                buffers.append(spectrum)
+                spectra.append(spectrum)
+                if matrix._spectrum is not None:
+                    spectrum.array[...] = matrix._spectrum
+                    continue
+                image = SharedArray(matrix.matrix.shape, matrix.matrix.dtype)
+                buffers.append(image)
+                image.array[...] = matrix.matrix
+                for channel in range(channels):
+                    pending.append(self.executor.submit(transformPlane, image.descriptor(), spectrum.descriptor(), channel, profiler.enabled))
+            for job in pending:
+                profiler.merge(job.result())
+            for (matrix, spectrum) in zip(matrices, spectra):
+                if matrix._spectrum is None:
+                    matrix._spectrum = spectrum.array.copy()
+            
+            #inverse transforms, one job per channel of every (image, filter) pair
+            outputs = []
+            pending = []
+            for (matrix, spectrum) in zip(matrices, spectra):
+                row = []
+                for spec in specs:
+                    out = SharedArray(matrix.matrix.shape, matrix.matrix.dtype)
+                    buffers.append(out)
+                    row.append(out)
+                    for channel in range(matrix.matrix.shape[2]):
+                        pending.append(self.executor.submit(filterAndInvert, spectrum.descriptor(), out.descriptor(), channel, matrix.pixels_per_degree, spec, clip, profiler.enabled))
+                outputs.append(row)
+            for job in pending:
+                profiler.merge(job.result())
             
-        return BlurringMatrix(numpy.clip(out, 0, 255), self.pixels_per_degree)
+            return [[BlurringMatrix(out.array, matrix.pixels_per_degree, out.array.dtype) for out in row] for (matrix, row) in zip(matrices, outputs)]
+        finally:
+            for buffer in buffers:
+                buffer.close()
+    def lowPassFilterMany(self, matrices, cyclesPerDegree, alpha="pass", luminance=False):
+        return self.filterMany(matrices, [GaussianLowPass(cpd) for cpd in iterCutoffs(cyclesPerDegree)], alpha=alpha, luminance=luminance)
+    def lowPassFilterBatch(self, matrix, cyclesPerDegree):
+        return self.lowPassFilterMany([matrix], cyclesPerDegree)[0]
+    def lowPassFilter(self, matrix, cyclesPerDegree):
+        return self.lowPassFilterMany([matrix], [cyclesPerDegree])[0][0]
+
+_default_engine = None
+
+#the engine used by concurrent=True filtering, started on first use and shut down at exit
+def defaultEngine():
+    global _default_engine
+    if _default_engine is None:
+        import atexit
+        _default_engine = Engine()
+        atexit.register(_default_engine.close)
+    return _default_engine
+
+#the cpd at which lowPassFilter blurs an axis of the given length with a spatial gaussian of the given width. The
+#frequency domain multiplier exp(-k**2/s**2), with s = pixels_per_degree*cpd/2, is a gaussian of width length/(s*pi*sqrt(2)).
+def cutoffForSigma(length, pixels_per_degree, sigma):
+    return 2.0 * length / (pixels_per_degree * sigma * math.pi * math.sqrt(2))
+
+#a common model of how acuity falls off with eccentricity (in degrees): full resolution at the fovea, halving by
+#half_resolution_eccentricity degrees out
+def eccentricityCutoff(eccentricity, fovea_cpd=40.0, half_resolution_eccentricity=2.3):
+    return fovea_cpd * half_resolution_eccentricity / (half_resolution_eccentricity + eccentricity)
+
+
+#low pass filters a bare array of pixels, either one plane (rows, columns) or (rows, columns, channels), returning the
+#clipped result as uint8. Kernels come from kernel_cache, so a stream of same-sized frames builds its kernel once.
+#backend is the FFT backend to use, getFFTBackend()'s choice by default.
+def lowPassArray(array, pixels_per_degree, cpd, dtype="float32", backend=None):
+    dtype = checkFloatType(dtype)
+    (cols, rows) = array.shape[:2]
+    backend = backend or getFFTBackend(array.size)
+    f = gaussianKernel(cols, rows, pixels_per_degree, cpd, dtype)
+    if array.ndim > 2:
+        f = f[:,:,numpy.newaxis]
+    out = backend.irfft2(backend.rfft2(array.astype(dtype), axes=(0,1)) * f, (cols, rows), axes=(0,1))
+    return numpy.clip(out, 0, 255, out=out).astype("uint8")
+
+#Reads and writes YUV4MPEG2 (.y4m) streams, one frame at a time. Frames are tuples of uint8 planes (Y, U, V), with
+#the chroma planes subsampled as the header's C tag says.
+y4m_subsampling = {"420": (2, 2), "420jpeg": (2, 2), "420paldv": (2, 2), "420mpeg2": (2, 2), "422": (1, 2), "444": (1, 1), "mono": None}
+
+class Y4MReader:
+    def __init__(self, stream):
+        self.stream = stream
+        header = stream.readline()
+        if not header.startswith(b"YUV4MPEG2"):
+            raise IOError("Not a YUV4MPEG2 stream.")
+        self.header = header
+        self.width = self.height = None
+        self.colorspace = "420jpeg"
+        for tag in header.split()[1:]:
+            (kind, value) = (tag[:1], tag[1:].decode("ascii"))
+            if kind == b"W":
+                self.width = int(value)
+            elif kind == b"H":
+                self.height = int(value)
+            elif kind == b"C":
+                self.colorspace = value
+        if self.colorspace not in y4m_subsampling:
+            raise IOError("Unsupported YUV4MPEG2 colorspace C{0}.".format(self.colorspace))
+    
+    #the (rows, columns) of each plane of a frame
+    def planeShapes(self):
+        shapes = [(self.height, self.width)]
+        subsampling = y4m_subsampling[self.colorspace]
+        if subsampling is not None:
+            chroma = (-(-self.height // subsampling[0]), -(-self.width // subsampling[1]))
+            shapes += [chroma, chroma]
+        return shapes
+    
+    def __iter__(self):
+        shapes = self.planeShapes()
+        while True:
+            marker = self.stream.readline()
+            if not marker:
+                return
+            if not marker.startswith(b"FRAME"):
+                raise IOError("Corrupt YUV4MPEG2 stream.")
+            planes = []
+            for shape in shapes:
+                data = self.stream.read(shape[0] * shape[1])
+                if len(data) < shape[0] * shape[1]:
+                    return #truncated final frame
+                planes.append(numpy.frombuffer(data, dtype="uint8").reshape(shape))
+            yield tuple(planes)
+
+class Y4MWriter:
+    def __init__(self, stream, header):
+        self.stream = stream
+        stream.write(header)
+    def write(self, planes):
+        self.stream.write(b"FRAME\n")
+        for plane in planes:
+            self.stream.write(numpy.ascontiguousarray(plane, dtype="uint8").tobytes())
 
+#yields (rows, columns, channels) uint8 frames from a stream of raw interleaved pixels, such as ffmpeg's rgb24 output
+def readRawFrames(stream, width, height, channels=3):
+    size = width * height * channels
+    while True:
+        data = stream.read(size)
+        if len(data) < size:
+            return
+        yield numpy.frombuffer(data, dtype="uint8").reshape((height, width, channels))
 
-#performs a blur on one nxm array with the multiplier f
-def filterAndInvert(array, f, fftd=None):
-        if fftd is None:
-            fftd = numpy.fft.fft2(array)
-        low = fftd * f
-        ifftd = numpy.real(numpy.fft.ifft2(low))
-        return ifftd.reshape(array.shape[0], array.shape[1], 1)
+#yields the frames of an image sequence (a directory, read in name order, or a glob pattern) as uint8 arrays
+def readFrameSequence(source):
+    import glob
+    import os
+    if os.path.isdir(source):
+        names = sorted(os.path.join(source, name) for name in os.listdir(source) if not name.startswith("."))
+    else:
+        names = sorted(glob.glob(source))
+    from PIL import Image
+    for name in names:
+        if os.path.isfile(name):
+            yield pilPixels(Image.open(name))
+
+#filters one frame: a single array, or a tuple of planes as Y4MReader gives. Every plane, subsampled or not, is
+#filtered with the same pixels_per_degree: the kernel's cutoff is a fixed number of cycles across the whole plane,
+#and a subsampled plane covers the same visual angle as the full size one, so it gets the same cutoff in degrees.
+def filterFrame(frame, pixels_per_degree, cpd, dtype="float32", backend=None):
+    if isinstance(frame, tuple):
+        return tuple(lowPassArray(plane, pixels_per_degree, cpd, dtype, backend) for plane in frame)
+    return lowPassArray(frame, pixels_per_degree, cpd, dtype, backend)
+
+"""
+Low pass filters a stream of frames, yielding the filtered frames in their original order. Decoding (pulling from frames) runs on its own thread, and up to `workers` frames are filtered at once on a thread pool,
+so decode, FFT and whatever consumes the results overlap. At most 2*workers frames are in flight, so memory stays constant however long the clip is.
+If stats is a dict it is kept updated with the frame count, elapsed seconds and frames per second.
+"""
+def filterFrames(frames, pixels_per_degree, cpd, workers=None, dtype="float32", stats=None):
+    import concurrent.futures
+    import os
+    import queue
+    
+    workers = workers or os.cpu_count() or 1
+    depth = 2 * workers
+    backend = getFFTBackend().singleThreaded() if workers > 1 else None #the frames already run in parallel, like Engine workers
+    decoded = queue.Queue(maxsize=depth)
+    finished = object()
+    
+    def decode():
+        try:
+            for frame in frames:
+                decoded.put(frame)
+        except Exception as e:
+            decoded.put(e)
+        decoded.put(finished)
+    
+    reader = threading.Thread(target=decode)
+    reader.daemon = True
+    reader.start()
+    
+    start = time.time()
+    count = 0
+    done = False
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while not done and len(pending) < depth:
+                frame = decoded.get()
+                if frame is finished:
+                    done = True
+                elif isinstance(frame, Exception):
+                    raise frame
+                else:
+                    pending.append(executor.submit(filterFrame, frame, pixels_per_degree, cpd, dtype, backend))
+            if len(pending) == 0:
+                break
+            yield pending.popleft().result()
+            count += 1
+            if stats is not None:
+                elapsed = time.time() - start
+                stats.update({"frames": count, "elapsed": elapsed, "fps": count / elapsed if elapsed > 0 else 0.0})
+    reader.join()
+
+#bumped whenever a change alters filter output, so stale disk cache entries are never returned
+engine_version = "1"
+
+#A content-addressed cache of filtered outputs (and, with store_spectra, forward spectra) on disk, shared by every
+#process pointed at the same directory. Keys hash the source pixels with pixels_per_degree, cpd, method, dtype and
+#engine_version; values are .npy files, returned memory mapped. Files are written under a temporary name and renamed
+#into place, so readers never see a partial file and concurrent writers of the same key are harmless. Once the
+#directory grows past max_bytes the least recently used files (by modification time, which hits refresh) are removed.
+class DiskCache:
+    def __init__(self, directory, max_bytes=4*1024**3, store_spectra=False):
+        import os
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store_spectra = store_spectra
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.estimate = None #bytes in the directory as of the last scan plus what this process stored since
+        self.stores_since_scan = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+    
+    def makeKey(self, *parts):
+        import hashlib
+        return hashlib.sha256(repr((engine_version,) + parts).encode("utf-8")).hexdigest()
+    def filteredKey(self, matrix, spec, method, clip=True):
+        spec = next(iterFilters(spec))
+        return self.makeKey(spec.name, matrix.sourceHash(), float(matrix.pixels_per_degree), *(spec.params() + (method, matrix.matrix.dtype.str) + (() if clip else ("unclipped",))))
+    def spectrumKey(self, matrix):
+        return self.makeKey("spectrum", matrix.sourceHash(), matrix.matrix.dtype.str)
+    def path(self, key):
+        import os
+        return os.path.join(self.directory, key + ".npy")
+    
+    #the stored array for key, memory mapped, or None
+    def load(self, key):
+        import os
+        path = self.path(key)
+        try:
+            value = numpy.load(path, mmap_mode="r")
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+    def store(self, key, array):
+        import os
+        import tempfile
+        (handle, temporary) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                numpy.save(f, numpy.ascontiguousarray(array))
+                size = f.tell()
+            os.replace(temporary, self.path(key))
+        except:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            if self.estimate is not None:
+                self.estimate += size
+            self.stores_since_scan += 1
+            scan = self.estimate is None or self.estimate > self.max_bytes or self.stores_since_scan >= self.rescan_stores
+        if scan:
+            self.evict()
+    
+    #Listing and statting the whole directory on every store gets slow as the cache grows, so the size is tracked as
+    #entries are stored and the directory is only scanned once that estimate passes max_bytes, or every rescan_stores
+    #stores to catch up with other processes sharing the directory. Eviction then makes room down to low_water times
+    #max_bytes, so that a full cache is not rescanned on every store that follows.
+    rescan_stores = 64
+    low_water = 0.9
+    
+    #removes the least recently used entries, if the cache is over max_bytes, until it fits in low_water * max_bytes
+    def evict(self):
+        import os
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue #removed by another process
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort()
+        limit = self.max_bytes * self.low_water if total > self.max_bytes else total
+        for (_, size, name) in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+        with self.lock:
+            self.estimate = total
+            self.stores_since_scan = 0
+    def clear(self):
+        import os
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        with self.lock:
+            self.estimate = None
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "directory": self.directory, "max_bytes": self.max_bytes}
+
+_disk_cache = None
+
+#sets the DiskCache used by default for filtering, or None to stop using one
+def setDiskCache(cache):
+    global _disk_cache
+    _disk_cache = cache if cache is not None else False
+    return cache
+
+#the default DiskCache, created on first use from the BLUR_CACHE_DIR environment variable if it is set, otherwise None
+def getDiskCache():
+    global _disk_cache
+    if _disk_cache is None:
+        import os
+        directory = os.environ.get("BLUR_CACHE_DIR")
+        _disk_cache = DiskCache(directory) if directory else False
+    return _disk_cache or None
+
+#A gaussian pyramid built once from a BlurringMatrix, from which an image blurred by a different amount at every pixel
+#can be synthesized. Level k is the image blurred with the 5-tap binomial filter and halved k times; expanded back to
+#full size it approximates a gaussian blur of level_sigmas[k] = sqrt((4**k - 1)/2) pixels (an empirical fit, within
+#about a grey level of lowPassFilter at each level's cutoff on photographs). Any other amount of blur is a
+#blend of the two levels around it, so a smooth, many-level falloff costs about 4/3 of the image in memory and one
+#cheap reduction per level, instead of a full resolution FFT and copy for each level.
+class BlurPyramid:
+    reduce_taps = numpy.array([6.0, 4.0, 1.0]) / 16.0 #centre first, as convolveAxis takes them
+    
+    def __init__(self, matrix, levels=None, dtype="float32"):
+        if(not matrix.resolutionIsCalculated()):
+            raise RuntimeError("The pixels_per_degree must be set before a pyramid can be built.")
+        self.pixels_per_degree = matrix.pixels_per_degree
+        self.shape = matrix.matrix.shape
+        if levels is None:
+            levels = max(1, int(math.log(min(self.shape[:2]), 2)) - 2)
+        
+        taps = self.reduce_taps.astype(dtype)
+        self.levels = [matrix.matrix.astype(dtype)]
+        for _ in range(levels):
+            level = convolveAxis(convolveAxis(self.levels[-1], taps, 0), taps, 1)
+            self.levels.append(numpy.ascontiguousarray(level[::2, ::2]))
+        self.level_sigmas = numpy.sqrt((4.0**numpy.arange(len(self.levels)) - 1) / 2.0)
+    
+    #the cpd each level approximates. The pyramid blurs both axes by the same number of pixels, while lowPassFilter's
+    #blur along an axis is proportional to its length, so on a non-square image no level matches it on both axes; the
+    #cutoffs here use the geometric mean of the two lengths, which puts each axis off by the square root of the aspect
+    #ratio (about 15% at 4:3), wider along the short axis and narrower along the long one.
+    def levelCutoffs(self):
+        length = math.sqrt(self.shape[0] * self.shape[1])
+        return [float("inf")] + [cutoffForSigma(length, self.pixels_per_degree, sigma) for sigma in self.level_sigmas[1:]]
+    
+    #the fractional level (0 is the original, 1.5 halfway between levels 1 and 2) that gives each cutoff's blur,
+    #interpolating between the levels' blur widths. Like levelCutoffs, this is exact only for square images.
+    def levelPositions(self, cutoffs):
+        length = math.sqrt(self.shape[0] * self.shape[1])
+        with numpy.errstate(divide="ignore"):
+            sigma = cutoffForSigma(length, self.pixels_per_degree, numpy.asarray(cutoffs, dtype="float64"))
+        return numpy.interp(sigma, self.level_sigmas, numpy.arange(len(self.levels))).astype(self.levels[0].dtype)
+    
+    #doubles the resolution of part of level k+1 by bilinear interpolation. source covers the level k+1 index ranges
+    #source_region, and the result covers the level k ranges region. Reducing keeps every other pixel, so pixel j of
+    #level k+1 sits at pixel 2j of level k.
+    def expand(self, source, source_region, region, k):
+        size = self.levels[k + 1].shape
+        out = source
+        for axis in (0, 1):
+            indices = numpy.arange(region[2*axis], region[2*axis + 1])
+            position = numpy.clip(indices / 2.0, 0, size[axis] - 1) - source_region[2*axis]
+            low = numpy.floor(position).astype(numpy.intp)
+            high = numpy.minimum(low + 1, out.shape[axis] - 1)
+            weight = (position - low).astype(out.dtype).reshape((-1,) + (1,) * (out.ndim - 1 - axis))
+            first = numpy.take(out, low, axis=axis)
+            out = first + (numpy.take(out, high, axis=axis) - first) * weight
+        return out
+    
+    """
+    Collapses the pyramid into one image where each pixel has the blur of its fractional level in positions (see levelPositions), over the given rows and cols slices of the image.
+    Works from the coarsest level needed down to full resolution: at each level the expanded coarser result is blended with that level by clip(position - k, 0, 1),
+    so the cost is about 4/3 of a single full resolution blend however many levels there are.
+    """
+    def collapse(self, positions, rows, cols):
+        positions = numpy.broadcast_to(positions, (rows.stop - rows.start, cols.stop - cols.start))
+        top = min(len(self.levels) - 1, int(math.ceil(positions.max())))
+        regions = [(rows.start, rows.stop, cols.start, cols.stop)]
+        for k in range(1, top + 1):
+            (r0, r1, c0, c1) = regions[-1]
+            size = self.levels[k].shape
+            regions.append((max(r0//2 - 1, 0), min((r1 + 1)//2 + 1, size[0]), max(c0//2 - 1, 0), min((c1 + 1)//2 + 1, size[1])))
+        
+        (r0, r1, c0, c1) = regions[top]
+        out = self.levels[top][r0:r1, c0:c1]
+        for k in range(top - 1, -1, -1):
+            (r0, r1, c0, c1) = regions[k]
+            coarse = self.expand(out, regions[k + 1], regions[k], k)
+            fine = self.levels[k][r0:r1, c0:c1]
+            #positions sampled where this level's pixels sit at full resolution
+            scale = 2**k
+            y = numpy.clip(numpy.arange(r0, r1) * scale - rows.start, 0, positions.shape[0] - 1)
+            x = numpy.clip(numpy.arange(c0, c1) * scale - cols.start, 0, positions.shape[1] - 1)
+            weight = numpy.clip(positions[y[:, numpy.newaxis], x[numpy.newaxis, :]] - k, 0, 1)
+            if fine.ndim > 2:
+                weight = weight[..., numpy.newaxis]
+            out = fine + (coarse - fine) * weight
+        return numpy.clip(out, 0, 255)
+    
+    """
+    Synthesizes the image with a different low pass cutoff at every pixel. cutoffs holds a cpd per pixel of the region given by the rows and cols slices (the whole image by default), or is a single cpd for all of them.
+    Returns a float array of the region, clipped to 0-255.
+    """
+    def synthesize(self, cutoffs, rows=None, cols=None):
+        rows = rows if rows is not None else slice(0, self.shape[0])
+        cols = cols if cols is not None else slice(0, self.shape[1])
+        return self.collapse(self.levelPositions(cutoffs), rows, cols)
+    
+    """
+    Synthesizes the image as seen while fixating position (row, column), with the cutoff at each pixel given by falloff(eccentricity in degrees), using pixels_per_degree.
+    As with synthesize(), rows and cols can restrict the work to a region of the image.
+    """
+    def foveate(self, position, falloff=eccentricityCutoff, rows=None, cols=None):
+        rows = rows if rows is not None else slice(0, self.shape[0])
+        cols = cols if cols is not None else slice(0, self.shape[1])
+        y = (numpy.arange(rows.start, rows.stop) - position[0])[:, numpy.newaxis]
+        x = (numpy.arange(cols.start, cols.stop) - position[1])[numpy.newaxis, :]
+        eccentricity = numpy.sqrt(y**2 + x**2) / self.pixels_per_degree
+        return self.synthesize(falloff(eccentricity), rows, cols)
+
+#opens image data for tiled filtering without reading it into memory. .npy files and uncompressed TIFFs (through the
+#optional tifffile package) carry their own shape; anything else is treated as raw interleaved pixels of the given
+#shape (rows, columns, channels) and dtype.
+def openMemmap(path, shape=None, dtype="uint8"):
+    lowered = path.lower()
+    if lowered.endswith(".npy"):
+        return numpy.load(path, mmap_mode="r")
+    if lowered.endswith((".tif", ".tiff")):
+        try:
+            import tifffile
+        except:
+            raise ImportError("Could not import tifffile.")
+        return tifffile.memmap(path, mode="r")
+    if shape is None:
+        raise ValueError("The shape of raw image data must be given.")
+    return numpy.memmap(path, dtype=dtype, mode="r", shape=tuple(shape))
+
+#creates a memory mapped output file of the given shape, in the same formats openMemmap() reads
+def createMemmap(path, shape, dtype="uint8"):
+    lowered = path.lower()
+    if lowered.endswith(".npy"):
+        return numpy.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+    if lowered.endswith((".tif", ".tiff")):
+        try:
+            import tifffile
+        except:
+            raise ImportError("Could not import tifffile.")
+        return tifffile.memmap(path, shape=tuple(shape), dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+
+#filters one tile of source along one axis into destination by overlap-save: the tile is read together with a halo
+#as wide as the kernel radius on both sides of that axis only, convolved, and the halo is discarded. With clip an
+#integer destination has the result clipped to the range of its type (0-255 for uint8, 0-65535 for uint16) before it
+#is stored.
+def filterTile(source, destination, top, left, bottom, right, taps, axis, dtype, clip=True):
+    (start, stop) = ((top, bottom), (left, right))[axis]
+    halo = len(taps) - 1
+    (read_start, read_stop) = (max(0, start - halo), min(source.shape[axis], stop + halo))
+    index = [slice(top, bottom), slice(left, right)]
+    index[axis] = slice(read_start, read_stop)
+    region = numpy.asarray(source[tuple(index)], dtype=dtype)
+    
+    #where the halo runs off the image, mirror it (wrapping around like spatialLowPass would mean reading the far side)
+    padding = [(0, 0)] * region.ndim
+    padding[axis] = (halo - (start - read_start), halo - (read_stop - stop))
+    if any(padding[axis]):
+        region = numpy.pad(region, padding, mode="symmetric")
+    
+    index[axis] = slice(halo, halo + stop - start)
+    index[1 - axis] = slice(None)
+    out = convolveAxis(region, taps, axis)[tuple(index)]
+    if clip and destination.dtype.kind in "ui":
+        limits = numpy.iinfo(destination.dtype)
+        numpy.clip(out, limits.min, limits.max, out=out)
+    destination[top:bottom, left:right] = out.astype(destination.dtype)
+
+"""
+Low pass filters an image too large to hold in memory, tile by tile, with peak memory bounded by the tile size and the kernel radius instead of the image size.
+source and destination are arrays of the same (rows, columns[, channels]) shape, normally memmaps from openMemmap() and createMemmap(); strings are opened as such, a new destination taking the source's type.
+Results are clipped to the range of an integer destination's type, so 16 bit sources keep their full range.
+The filter is the spatial form of lowPassFilter (see spatialLowPass), but mirrored at the edges of the image instead of wrapped around, run as two passes, one per axis, through an intermediate memmap of dtype values in the directory scratch (the system's temporary directory by default), so that each pass needs a halo along its own axis only.
+The radius r of the kernel grows with the length of the axis (about 1.75 * length / (pixels_per_degree * cpd) pixels), so along the axis being filtered a tile is made at least 2r long, which keeps the halo from more than doubling the work. Each of up to `workers` threads then holds about 2 * (max(tile_size, 2r) + 2r) * tile_size * channels values of dtype at a time, and the intermediate file takes one dtype copy of the image on disk.
+"""
+def lowPassFilterTiled(source, destination, pixels_per_degree, cpd, tile_size=1024, workers=None, dtype="float32", shape=None, scratch=None):
+    import concurrent.futures
+    import tempfile
+    
+    if isinstance(source, str):
+        source = openMemmap(source, shape)
+    if isinstance(destination, str):
+        destination = createMemmap(destination, source.shape, source.dtype)
+    if destination.shape != source.shape:
+        raise ValueError("The destination shape {0} does not match the source shape {1}.".format(destination.shape, source.shape))
+    
+    dtype = checkFloatType(dtype)
+    (cols, rows) = source.shape[:2]
+    taps = (spatialKernel(cols, pixels_per_degree, cpd, dtype), spatialKernel(rows, pixels_per_degree, cpd, dtype))
+    
+    with tempfile.TemporaryFile(dir=scratch) as f:
+        between = numpy.memmap(f, dtype=dtype, mode="w+", shape=source.shape)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for (axis, read, write) in ((0, source, between), (1, between, destination)):
+                span = [tile_size, tile_size]
+                span[axis] = max(tile_size, 2 * (len(taps[axis]) - 1))
+                jobs = [executor.submit(filterTile, read, write, top, left, min(top + span[0], cols), min(left + span[1], rows), taps[axis], axis, dtype, write is destination)
+                        for top in range(0, cols, span[0]) for left in range(0, rows, span[1])]
+                for job in jobs:
+                    job.result()
+        del between
+    if isinstance(destination, numpy.memmap):
+        destination.flush()
+    return destination
 
 #computes the meshgrid frequency matrix of the m by n matrix. Derived from matlab code.
 #Copyright 2002-2004 R. C. Gonzalez, R. E. Woods, & S. L. Eddins 
@@ -199,3 +1755,15 @@ def meshgridFrequencyMatrix(m, n):
     
     [v,u] = numpy.meshgrid(v, u)
     return (u, v)
+
+#computes the frequency matrix of the m by n matrix for a real-input transform, which keeps only the non-negative
+#half of the second axis. The values match the first n//2 + 1 columns of meshgridFrequencyMatrix(m, n).
+def halfMeshgridFrequencyMatrix(m, n):
+    u = numpy.arange(0, m)
+    v = numpy.arange(0, n//2 + 1)
+    
+    idx = (u > m/2.0).nonzero()
+    u[idx] = u[idx] - m
+    
+    [v,u] = numpy.meshgrid(v, u)
+    return (u, v)
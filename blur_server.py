@@ -0,0 +1,229 @@
+import blur
+import os
+import io
+import sys
+import json
+import signal
+import time
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import urllib.parse
+
+#A local HTTP service for blurred images, so callers pay for interpreter startup and imports once instead of on every
+#request. Requests look like
+#    GET /blur?src=stimuli/face.jpg&cpd=5&format=png
+#where src is relative to the served root. Filtering runs on a bounded pool of worker processes, each keeping the
+#sources it decoded recently (with their spectra) and its kernel cache warm. Identical requests in flight at the same
+#time share one job. GET /stats reports request counts, latency percentiles and queue depth as JSON.
+
+formats = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "jpg": ("JPEG", "image/jpeg")}
+chunk_size = 64 * 1024
+geometry = ((1024, 768), (36, 27), 61) #the viewing geometry main_pil.py assumes
+
+#per worker process, the most recently used decoded sources keyed on (path, mtime)
+_sources = collections.OrderedDict()
+source_cache_size = 8
+
+def load_source(path, mtime, dtype):
+    key = (path, mtime, dtype)
+    matrix = _sources.get(key)
+    if matrix is None:
+        matrix = blur.open(path, blur.Types.PIL, dtype).calcPixelsPerDegree(*geometry)
+        _sources[key] = matrix
+        while len(_sources) > source_cache_size:
+            _sources.popitem(last=False)
+    else:
+        _sources.move_to_end(key)
+    return matrix
+
+#runs in a worker process: filters the source and returns the encoded image
+def render(path, mtime, cpd, format, dtype):
+    matrix = load_source(path, mtime, dtype)
+    output = blur.exportToPIL(matrix.lowPassFilter(cpd))
+    if formats[format][0] == "JPEG" and output.mode not in ("L", "RGB"):
+        output = output.convert("L" if output.mode == "LA" else "RGB") #JPEG has no alpha channel
+    buffer = io.BytesIO()
+    output.save(buffer, formats[format][0])
+    return buffer.getvalue()
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+reasons = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class BlurServer:
+    def __init__(self, root, workers=None, max_queue=64, dtype="float32"):
+        self.root = os.path.realpath(root)
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.dtype = dtype
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=blur.startEngineWorker) #one FFT thread per worker
+        self.in_flight = {}
+        self.latencies = collections.deque(maxlen=1000)
+        self.counts = collections.Counter()
+        self.started = time.time()
+        self.server = None
+
+    #the worker processes are started before listening: forked workers inherit every open descriptor, so a pool forked
+    #while handling a connection would hold that client's socket, and the listening one, open for as long as it lives
+    async def start(self, host="127.0.0.1", port=8765):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, os.getpid) for _ in range(self.workers)])
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown()
+
+    def resolve(self, src):
+        if not src:
+            raise HTTPError(400, "src is required.")
+        path = os.path.realpath(os.path.join(self.root, src))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise HTTPError(403, "src must be inside the served directory.")
+        if not os.path.isfile(path):
+            raise HTTPError(404, "No such image: {0}".format(src))
+        return path
+
+    #the encoded image for the request, sharing the job of any identical request already in flight
+    async def blurred(self, query):
+        path = self.resolve(query.get("src", [""])[0])
+        try:
+            cpd = float(query.get("cpd", [""])[0])
+        except ValueError:
+            raise HTTPError(400, "cpd must be a number.")
+        if not cpd > 0:
+            raise HTTPError(400, "cpd must be positive.")
+        format = query.get("format", ["png"])[0].lower()
+        if format not in formats:
+            raise HTTPError(400, "format must be one of {0}.".format(", ".join(sorted(formats))))
+
+        key = (path, os.path.getmtime(path), cpd, formats[format][0])
+        job = self.in_flight.get(key)
+        if job is not None:
+            self.counts["coalesced"] += 1
+        else:
+            if len(self.in_flight) >= self.max_queue:
+                raise HTTPError(503, "Too many requests queued.")
+            loop = asyncio.get_running_loop()
+            job = loop.run_in_executor(self.executor, render, path, key[1], cpd, format, self.dtype)
+            self.in_flight[key] = job
+            job.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        try:
+            data = await asyncio.shield(job) #a client hanging up must not cancel the job for everyone else
+        except IOError:
+            raise HTTPError(400, "Could not open the source as an image.")
+        return (data, formats[format][1])
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if len(latencies) == 0:
+                return None
+            return latencies[min(len(latencies) - 1, int(p / 100.0 * len(latencies)))] * 1000.0
+        return {
+            "uptime_s": time.time() - self.started,
+            "workers": self.workers,
+            "queue_depth": len(self.in_flight),
+            "max_queue": self.max_queue,
+            "requests": dict(self.counts),
+            "latency_ms": {"p50": percentile(50), "p90": percentile(90), "p99": percentile(99), "samples": len(latencies)},
+        }
+
+    async def respond(self, writer, status, content_type, body, keep_alive, head=False):
+        header = "HTTP/1.1 {0} {1}\r\nContent-Type: {2}\r\nTransfer-Encoding: chunked\r\nConnection: {3}\r\n\r\n".format(
+            status, reasons.get(status, ""), content_type, "keep-alive" if keep_alive else "close")
+        writer.write(header.encode("ascii"))
+        if not head:
+            for start in range(0, len(body), chunk_size):
+                piece = body[start:start + chunk_size]
+                writer.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request = lines[0].split()
+                headers = dict((name.strip().lower(), value.strip()) for (name, _, value) in (line.partition(":") for line in lines[1:] if line))
+                version = request[2] if len(request) > 2 else "HTTP/1.0"
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+                start = time.perf_counter()
+                url = None
+                try:
+                    if len(request) < 2:
+                        raise HTTPError(400, "Malformed request line.")
+                    if request[0] not in ("GET", "HEAD"):
+                        raise HTTPError(405, "Only GET and HEAD are supported.")
+                    url = urllib.parse.urlsplit(request[1])
+                    query = urllib.parse.parse_qs(url.query)
+                    if url.path == "/stats":
+                        (body, content_type) = (json.dumps(self.stats(), indent=1).encode("utf-8"), "application/json")
+                    elif url.path == "/blur":
+                        (body, content_type) = await self.blurred(query)
+                    else:
+                        raise HTTPError(404, "Unknown path {0}".format(url.path))
+                    status = 200
+                except HTTPError as e:
+                    (status, body, content_type) = (e.status, (str(e) + "\n").encode("utf-8"), "text/plain")
+                except Exception as e:
+                    (status, body, content_type) = (500, (str(e) + "\n").encode("utf-8"), "text/plain")
+
+                self.counts[status] += 1
+                if status == 200 and url.path == "/blur":
+                    self.latencies.append(time.perf_counter() - start)
+                await self.respond(writer, status, content_type, body, keep_alive, len(request) > 0 and request[0] == "HEAD")
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    server = BlurServer(args.root, args.workers, args.max_queue, args.dtype)
+    (host, port) = await server.start(args.host, args.port)
+    print("Serving blurred images from {0} on http://{1}:{2}/".format(server.root, host, port))
+    sys.stdout.flush()
+    #stops cleanly on SIGTERM as well as Ctrl-C, so the worker processes are shut down rather than left behind
+    stopped = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    except NotImplementedError: #not available on Windows
+        pass
+    try:
+        await stopped.wait()
+    finally:
+        await server.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves low-pass filtered images over HTTP: GET /blur?src=NAME&cpd=CPD&format=png|jpeg, and GET /stats.")
+    parser.add_argument("root", help="Directory the src of each request is relative to.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--workers", "-j", type=int, default=os.cpu_count() or 1, help="Number of filtering worker processes.")
+    parser.add_argument("--max-queue", type=int, default=64, help="Distinct requests allowed in flight before new ones are refused with 503.")
+    parser.add_argument("--dtype", choices=blur.float_types, default="float32", help="Precision to filter in.")
+
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
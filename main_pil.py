@@ -1,74 +1,268 @@
 import blur
 import time
 import os
+import glob
 import argparse
-import numpy
+import collections
+import itertools
+import json
 
-from PIL import PngImagePlugin, BmpImagePlugin, JpegImagePlugin, TiffImagePlugin, GifImagePlugin
+image_extensions = (".tif", ".tiff", ".jpg", ".jpeg", ".png", ".bmp", ".gif")
+saving_error_msg = "Could not save to the indicated path, please make sure the output filename is a valid image format. Exiting."
+manifest_name = ".blur_manifest.json"
 
-parser = argparse.ArgumentParser(description="Takes in a file and applies a low-pass blur filter. Supported formats are tif, jpg, png, bmp, and gif.")
-parser.add_argument("cycles_per_degree", type=float, help="The lower bound cycles per degree of the filter.")
-parser.add_argument("source_file", help="Filename of the image to apply the filter to.")
-parser.add_argument("destination_file", nargs="?", default=None, help="Filename to write the filtered image to. If not given, the image is display on screen.")
-parser.add_argument("-concurrent, -c", dest="concurrent", action="store_true", help="If set, the blur will be generated concurrently. Only supported under Python 3.x and up.")
+#expands the source argument into (source, relative output name) pairs. The source may be an image, a directory of
+#images, a glob pattern, or @listfile naming one image per line.
+def find_sources(source):
+    if source.startswith("@"):
+        with open(source[1:]) as listing:
+            return relative_names([line.strip() for line in listing if line.strip()])
+    if os.path.isdir(source):
+        found = []
+        for (root, dirs, files) in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(image_extensions):
+                    path = os.path.join(root, name)
+                    found.append((path, os.path.relpath(path, source)))
+        return found
+    if glob.has_magic(source):
+        return relative_names([path for path in sorted(glob.glob(source)) if os.path.isfile(path)])
+    return [(source, source)]
 
-args = parser.parse_args()
+#names each path relative to the deepest directory holding all of them, so that files of the same name from different
+#directories keep apart (when they all share one directory, that is just their basename). Repeats are dropped.
+def relative_names(paths):
+    unique = collections.OrderedDict()
+    for path in paths:
+        unique.setdefault(os.path.abspath(path), path)
+    if len(unique) == 0:
+        return []
+    root = os.path.commonpath([os.path.dirname(path) for path in unique])
+    return [(path, os.path.relpath(absolute, root)) for (absolute, path) in unique.items()]
 
-image_prompt = "Filename or directory to blur: "
-cpd_prompt = "CPD Bound: "
-save_prompt = "Filename or directory to save to: "
-saving_error_msg = "Could not save to the indicated path, please make sure the output filename is a valid image format. Exiting."
+#The manifest records, in the destination directory, the source and filter parameters each output was written with,
+#keyed by its relative name, so that an output is only skipped when it was filtered from the same source the same way.
+def load_manifest(savedir):
+    try:
+        with open(os.path.join(savedir, manifest_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 
-cpd = args.cycles_per_degree
-filename = args.source_file
-savedir = args.destination_file
-saved_to_dir = False
+def save_manifest(savedir, manifest):
+    path = os.path.join(savedir, manifest_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
 
-if savedir is not None:
-    if os.path.isfile(savedir):
-        saved_to_dir = False
-    elif os.path.isdir(savedir):
-        saved_to_dir = True
-    else:
-        if "." not in savedir:
-            saved_to_dir = True
+def is_up_to_date(source, destination, entry, params):
+    if entry is None or entry.get("source") != os.path.abspath(source) or entry.get("params") != params:
+        return False
+    try:
+        return os.path.getmtime(destination) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+def decode(source, dtype="float64"):
+    return blur.open(source, blur.Types.PIL, dtype).calcPixelsPerDegree((1024, 768), (36, 27), 61)
+
+def encode(matrix, destination):
+    directory = os.path.dirname(destination)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass #another encoder got there first
+    output = blur.exportToPIL(matrix)
+    with blur.profiler.stage("save"):
+        output.save(destination)
+    return os.path.getsize(destination)
+
+#Runs decode -> filter -> encode as a pipeline. Decoding and encoding happen on thread pools, filtering goes through
+#one shared engine in groups of up to `jobs` images. At most 2*jobs images are decoded ahead and at most 2*jobs are
+#waiting to be saved, which bounds memory no matter how many files are queued.
+def run_batch(pairs, cpd, jobs, use_engine, dtype="float64", alpha="pass", luminance=False):
+    import concurrent.futures
+
+    depth = 2 * jobs
+    decoder = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    encoder = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    engine = None
+    if use_engine:
+        try:
+            engine = blur.Engine(workers=jobs)
+        except ImportError:
+            print("Unable to import concurrency libraries. Ensure you are using Python 3.x or higher. Continuing normally.")
+
+    stats = {"done": 0, "failed": 0, "pixels": 0, "written": 0, "saved": []}
+    start = time.time()
+    decoding = collections.deque()
+    saving = collections.deque()
+    pending = iter(pairs)
+
+    def finish_saves(limit):
+        while len(saving) > limit:
+            (source, destination, pixels, job) = saving.popleft()
             try:
-                os.makedirs(savedir)
-            except:
-                print("Could not create the destination directory. Exiting.")
-                exit(-1)
+                stats["written"] += job.result()
+            except Exception as e:
+                print("Could not save the filtered {0}: {1}".format(source, e))
+                stats["failed"] += 1
+            else:
+                stats["done"] += 1
+                stats["pixels"] += pixels
+                stats["saved"].append((source, destination))
+
+    try:
+        while True:
+            for (source, destination) in itertools.islice(pending, depth - len(decoding)):
+                decoding.append((source, destination, decoder.submit(decode, source, dtype)))
+            if len(decoding) == 0:
+                break
+
+            group = []
+            while len(decoding) > 0 and len(group) < jobs:
+                (source, destination, job) = decoding.popleft()
+                try:
+                    group.append((source, destination, job.result()))
+                except IOError:
+                    print("Could not open {0} as an image. Skipping.".format(source))
+                    stats["failed"] += 1
+            if len(group) == 0:
+                continue
+
+            if engine is not None:
+                results = [row[0] for row in engine.lowPassFilterMany([matrix for (_, _, matrix) in group], [cpd], alpha=alpha, luminance=luminance)]
+            else:
+                results = [matrix.lowPassFilter(cpd, alpha=alpha, luminance=luminance) for (_, _, matrix) in group]
+
+            for ((source, destination, matrix), result) in zip(group, results):
+                pixels = matrix.matrix.shape[0] * matrix.matrix.shape[1]
+                saving.append((source, destination, pixels, encoder.submit(encode, result, destination)))
+            finish_saves(depth)
+        finish_saves(0)
+    finally:
+        decoder.shutdown()
+        encoder.shutdown()
+        if engine is not None:
+            engine.close()
+
+    stats["elapsed"] = time.time() - start
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Takes in a file and applies a low-pass blur filter. Supported formats are tif, jpg, png, bmp, and gif, in grayscale or color, with or without transparency.")
+    parser.add_argument("cycles_per_degree", type=float, help="The lower bound cycles per degree of the filter.")
+    parser.add_argument("source_file", help="Filename of the image to apply the filter to. May also be a directory, a quoted glob pattern, or @listfile with one filename per line.")
+    parser.add_argument("destination_file", nargs="?", default=None, help="Filename to write the filtered image to. If not given, the image is display on screen. Required, and treated as a directory, when filtering more than one image.")
+    parser.add_argument("-concurrent, -c", dest="concurrent", action="store_true", help="If set, the blur will be generated concurrently. Only supported under Python 3.x and up.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="Number of decode, filter and encode workers used when filtering more than one image.")
+    parser.add_argument("--dtype", choices=blur.float_types, default="float64", help="Precision to filter in. float32 uses half the memory and differs from float64 by at most one grey level.")
+    parser.add_argument("--luminance", action="store_true", help="Filter only the luminance of color images, leaving their color untouched. About three times less work.")
+    parser.add_argument("--filter-alpha", dest="alpha", action="store_const", const="filter", default="pass", help="Blur the alpha channel of transparent images too, instead of keeping it as it is.")
+    parser.add_argument("--force", "-f", action="store_true", help="Filter every image, even those whose output is already newer than the source and was filtered with the same settings.")
+    parser.add_argument("--profile", default=None, metavar="PATH", help="Record how long each stage of the pipeline takes and write the report to PATH.")
+    parser.add_argument("--profile-format", choices=("json", "chrome"), default="json", help="json for per stage totals, chrome for a trace viewable in chrome://tracing or Perfetto.")
+
+    args = parser.parse_args()
 
-try:
-    generator = blur.open(filename, blur.Types.PIL)
-except IOError:
-    print("Could not open {0} as an image. Exiting.".format(filename))
-    exit(-1)
-
-print("Applying filter of {0:f} cycles per degree to {1}".format(cpd, filename))
-
-generator.calcPixelsPerDegree((1024, 768), (36, 27), 61)
-try:
-    generator = generator.lowPassFilter(cpd, concurrent=args.concurrent)
-except ImportError:
-    print("Unable to import concurrency libraries. Ensure you are using Python 3.x or higher. Continuing normally.")
-    generator = generator.lowPassFilter(cpd, concurrent=False)
-output = blur.exportToPIL(generator)
-
-if savedir is not None:
-    if saved_to_dir:
-        savepath = os.path.join(savedir, filename)
-        print("Saving {0} to {1}".format(filename, savepath))
+    if args.profile is not None:
+        blur.profiler.enable()
         try:
-            output.save(savepath)
-        except:
-            print(saving_error_msg)
-            exit(-1)
+            run(args)
+        finally:
+            blur.profiler.dump(args.profile, args.profile_format)
+            print("Wrote profile to {0}".format(args.profile))
     else:
-        print("Saving {0}".format(savedir))
+        run(args)
+
+def run(args):
+    cpd = args.cycles_per_degree
+    filename = args.source_file
+    savedir = args.destination_file
+    saved_to_dir = False
+
+    batch = filename.startswith("@") or os.path.isdir(filename) or glob.has_magic(filename)
+
+    if savedir is not None:
+        if os.path.isfile(savedir) and not batch:
+            saved_to_dir = False
+        elif os.path.isdir(savedir):
+            saved_to_dir = True
+        else:
+            if "." not in savedir or batch:
+                saved_to_dir = True
+                try:
+                    os.makedirs(savedir)
+                except:
+                    print("Could not create the destination directory. Exiting.")
+                    exit(-1)
+
+    if batch:
+        if savedir is None:
+            print("A destination directory is required when filtering more than one image. Exiting.")
+            exit(-1)
+        params = {"cpd": cpd, "dtype": args.dtype, "alpha": args.alpha, "luminance": args.luminance, "engine_version": blur.engine_version}
+        manifest = load_manifest(savedir)
+        pairs = [(source, os.path.join(savedir, name)) for (source, name) in find_sources(filename)]
+        todo = [(source, destination) for (source, destination) in pairs
+                if args.force or not is_up_to_date(source, destination, manifest.get(os.path.relpath(destination, savedir)), params)]
+        skipped = len(pairs) - len(todo)
+
+        print("Applying filter of {0:f} cycles per degree to {1} images ({2} already up to date)".format(cpd, len(todo), skipped))
+        for (source, destination) in todo:
+            manifest.pop(os.path.relpath(destination, savedir), None) #until it has been written again
         try:
-            output.save(savedir)
-        except:
-            print(saving_error_msg)
+            stats = run_batch(todo, cpd, max(1, args.jobs), args.concurrent or args.jobs > 1, args.dtype, args.alpha, args.luminance)
+            for (source, destination) in stats["saved"]:
+                manifest[os.path.relpath(destination, savedir)] = {"source": os.path.abspath(source), "params": params}
+        finally:
+            save_manifest(savedir, manifest)
+
+        elapsed = max(stats["elapsed"], 1e-9)
+        print("Filtered {0} images ({1} skipped, {2} failed) in {3:.2f}s: {4:.2f} images/s, {5:.2f} megapixels/s, {6:.2f} MB written".format(
+            stats["done"], skipped, stats["failed"], stats["elapsed"], stats["done"] / elapsed, stats["pixels"] / 1e6 / elapsed, stats["written"] / 1e6))
+        if stats["failed"] > 0:
             exit(-1)
-else:
-    output.show()
+        return
+
+    try:
+        generator = blur.open(filename, blur.Types.PIL, args.dtype)
+    except IOError:
+        print("Could not open {0} as an image. Exiting.".format(filename))
+        exit(-1)
+
+    print("Applying filter of {0:f} cycles per degree to {1}".format(cpd, filename))
+
+    generator.calcPixelsPerDegree((1024, 768), (36, 27), 61)
+    try:
+        generator = generator.lowPassFilter(cpd, concurrent=args.concurrent, alpha=args.alpha, luminance=args.luminance)
+    except ImportError:
+        print("Unable to import concurrency libraries. Ensure you are using Python 3.x or higher. Continuing normally.")
+        generator = generator.lowPassFilter(cpd, concurrent=False, alpha=args.alpha, luminance=args.luminance)
+    output = blur.exportToPIL(generator)
+
+    if savedir is not None:
+        if saved_to_dir:
+            savepath = os.path.join(savedir, filename)
+            print("Saving {0} to {1}".format(filename, savepath))
+            try:
+                with blur.profiler.stage("save"):
+                    output.save(savepath)
+            except:
+                print(saving_error_msg)
+                exit(-1)
+        else:
+            print("Saving {0}".format(savedir))
+            try:
+                with blur.profiler.stage("save"):
+                    output.save(savedir)
+            except:
+                print(saving_error_msg)
+                exit(-1)
+    else:
+        output.show()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import blur
-import pygame
 import time
 import os
 import argparse
@@ -10,9 +9,22 @@ def main():
     parser.add_argument("source_file", help="Filename of the image to apply the filter to.")
     parser.add_argument("destination_file", nargs="?", default=None, help="Filename to write the filtered image to. If not given, the image is display on screen.")
     parser.add_argument("-concurrent, -c", dest="concurrent", action="store_true", help="If set, the blur will be generated concurrently. Only supported under Python 3.x and up.")
+    parser.add_argument("--profile", default=None, metavar="PATH", help="Record how long each stage of the pipeline takes and write the report to PATH.")
+    parser.add_argument("--profile-format", choices=("json", "chrome"), default="json", help="json for per stage totals, chrome for a trace viewable in chrome://tracing or Perfetto.")
 
     args = parser.parse_args()
 
+    if args.profile is not None:
+        blur.profiler.enable()
+        try:
+            run(args)
+        finally:
+            blur.profiler.dump(args.profile, args.profile_format)
+            print("Wrote profile to {0}".format(args.profile))
+    else:
+        run(args)
+
+def run(args):
     image_prompt = "Filename or directory to blur: "
     cpd_prompt = "CPD Bound: "
     save_prompt = "Filename or directory to save to: "
@@ -37,14 +49,15 @@ def main():
                     print("Could not create the destination directory. Exiting.")
                     exit(-1)
 
+    #imported here rather than at the top so --help and argument errors do not pay for it
+    import pygame
+
     try:
         generator = blur.open(filename, blur.Types.PYGAME)
     except IOError:
         print("Could not open {0} as an image. Exiting.".format(filename))
         exit(-1)
 
-    pygame.init()
-
     print("Applying filter of {0:f} cycles per degree to {1}".format(cpd, filename))
 
     generator.calcPixelsPerDegree((1024, 768), (36, 27), 61)
@@ -60,18 +73,21 @@ def main():
             savepath = os.path.join(savedir, filename)
             print("Saving {0} to {1}".format(filename, savepath))
             try:
-                pygame.image.save(output, savepath)
+                with blur.profiler.stage("save"):
+                    pygame.image.save(output, savepath)
             except:
                 print(saving_error_msg)
                 exit(-1)
         else:
             print("Saving {0}".format(savedir))
             try:
-                pygame.image.save(output, savedir)
+                with blur.profiler.stage("save"):
+                    pygame.image.save(output, savedir)
             except:
                 print(saving_error_msg)
                 exit(-1)
     else:
+        pygame.display.init() #only showing the result needs a display; loading and saving work without one
         screen = pygame.display.set_mode(output.get_size())
         screen.blit(output, (0,0))
         pygame.display.flip()
@@ -0,0 +1,107 @@
+import blur
+import os
+import sys
+import time
+import argparse
+import itertools
+import collections
+import numpy
+
+#Low pass filters a video, frame by frame, with the same filter as main_pil.py. Sources may be a YUV4MPEG2 (.y4m)
+#file, a directory or quoted glob pattern of numbered frames, or raw rgb24 (given --size) such as
+#    ffmpeg -i clip.mp4 -f rawvideo -pix_fmt rgb24 - | python main_video.py 5 - out.rgb --size 1280x720
+#Use - for stdin or stdout. Frames are streamed, so memory use does not grow with the length of the clip.
+
+def parse_size(text):
+    (width, height) = text.lower().split("x")
+    return (int(width), int(height))
+
+def binary_stream(name, mode):
+    if name == "-":
+        return sys.stdin.buffer if "r" in mode else sys.stdout.buffer
+    return open(name, mode)
+
+def main():
+    parser = argparse.ArgumentParser(description="Applies a low-pass blur filter to every frame of a video.")
+    parser.add_argument("cycles_per_degree", type=float, help="The lower bound cycles per degree of the filter.")
+    parser.add_argument("source", help="A .y4m file, a directory or quoted glob pattern of frames, or raw rgb24 frames (with --size). - reads stdin.")
+    parser.add_argument("destination", help="A .y4m file for .y4m sources, a directory for frame sequences, or a raw file. - writes stdout.")
+    parser.add_argument("--size", type=parse_size, default=None, help="WIDTHxHEIGHT of raw rgb24 frames.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="Number of frames filtered at once.")
+    parser.add_argument("--dtype", choices=blur.float_types, default="float32", help="Precision to filter in.")
+
+    args = parser.parse_args()
+    log = sys.stderr if args.destination == "-" else sys.stdout
+
+    source = None
+    destination = None
+    encoder = None
+    if args.size is not None:
+        (width, height) = args.size
+        source = binary_stream(args.source, "rb")
+        frames = blur.readRawFrames(source, width, height)
+    elif args.source == "-" or args.source.lower().endswith(".y4m"):
+        source = binary_stream(args.source, "rb")
+        try:
+            reader = blur.Y4MReader(source)
+        except IOError as e:
+            print("Could not read {0}: {1} Exiting.".format(args.source, e), file=log)
+            exit(-1)
+        (width, height) = (reader.width, reader.height)
+        frames = iter(reader)
+    else:
+        frames = blur.readFrameSequence(args.source)
+        first = next(frames, None)
+        if first is None:
+            print("No frames found in {0}. Exiting.".format(args.source), file=log)
+            exit(-1)
+        (height, width) = first.shape[:2]
+        frames = itertools.chain([first], frames)
+
+    stats = {"frames": 0, "elapsed": 0.0, "fps": 0.0}
+
+    #the same viewing geometry as main_pil.py
+    ppd = blur.BlurringMatrix(numpy.zeros((1, 1, 3))).calcPixelsPerDegree((1024, 768), (36, 27), 61).pixels_per_degree
+
+    if args.size is None and (args.source == "-" or args.source.lower().endswith(".y4m")):
+        destination = binary_stream(args.destination, "wb")
+        writer = blur.Y4MWriter(destination, reader.header)
+        write = writer.write
+    elif args.destination == "-" or "." in os.path.basename(args.destination):
+        destination = binary_stream(args.destination, "wb")
+        write = lambda frame: destination.write(frame.tobytes())
+    else:
+        from PIL import Image
+        if not os.path.isdir(args.destination):
+            os.makedirs(args.destination)
+        #PNG encoding is slow enough to be worth overlapping with filtering, so frames are saved on their own pool
+        import concurrent.futures
+        encoder = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs))
+        saving = collections.deque()
+        def save(frame, path):
+            Image.fromarray(frame).save(path)
+        def write(frame):
+            path = os.path.join(args.destination, "frame{0:06d}.png".format(stats["frames"]))
+            saving.append(encoder.submit(save, frame, path))
+            while len(saving) > 2 * max(1, args.jobs):
+                saving.popleft().result()
+
+    print("Applying filter of {0:f} cycles per degree to {1} ({2}x{3})".format(args.cycles_per_degree, args.source, width, height), file=log)
+    start = time.time()
+    try:
+        for frame in blur.filterFrames(frames, ppd, args.cycles_per_degree, max(1, args.jobs), args.dtype, stats):
+            write(frame)
+        if encoder is not None:
+            while len(saving) > 0:
+                saving.popleft().result()
+    finally:
+        if encoder is not None:
+            encoder.shutdown()
+        for stream in (source, destination):
+            if stream is not None and stream not in (sys.stdin.buffer, sys.stdout.buffer):
+                stream.close()
+    elapsed = max(time.time() - start, 1e-9)
+    print("Filtered {0} frames in {1:.2f}s: {2:.2f} frames/s".format(stats["frames"], elapsed, stats["frames"] / elapsed), file=log)
+
+if __name__ == "__main__":
+    main()
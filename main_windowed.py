@@ -3,7 +3,6 @@ import math
 import numpy as np
 import pygame
 import time
-import os
 import argparse
 
 #creates a list of samples for drawing the window. The first item in the list is the expected cpd, the rest are distributed along a curve
@@ -30,59 +29,172 @@ def make_window_prereqs(cpd, filename, num_samples=7, concurrent=False):
 
     return [blur.exportToPygame(s) for s in maker]
 
-#Given a screen, list of samples, radius, and position, a clear window is drawn with a gradient edge
-def window(screen, samples, window_radius, position):
-    (pos_x, pos_y) = position
-
-    radius = window_radius - (len(samples) * 2) #start the radius as smaller than the real radius, it will work out
-
-    #Set up the initial values of the output surface.
-    #For efficiency we pass in the actual screen as an argument, instead we could initialize a new surface and draw and return that
-    screen.set_colorkey((0,0,0)) #colorkey is the replaced value
-    screen.blit(samples[-1], (pos_x - radius, pos_y - radius), (pos_x - radius, pos_y - radius, radius*2, radius*2)) #this copies only the relavent portion of the clearest image. Since its the smallest, the smaller square comes out
-
-    #loop over each sample but the blurriest, draw a circle of transparency, and paste it over the output surface
-    for index in range(2, len(samples) - 1):
-        radius += 2
-        dubradius = radius*2
-        noutput = pygame.Surface((dubradius, dubradius)) #needs a new surface for a) effiency and b) so that the samples are not altered
-        noutput.blit(samples[-index], (0,0), (pos_x - radius, pos_y - radius, dubradius, dubradius)) #again only copy the relavent area, its alot faster than the whole thing
-        noutput.set_colorkey((0,0,0), pygame.RLEACCEL)
-        pygame.draw.circle(noutput, (0,0,0), (radius, radius), radius) #since the box is only radius*2 in each dimension, the circle is positioned at its center, or (radius, radius)
-        screen.blit(noutput, (pos_x - radius, pos_y - radius))
-
-    #now do it again for the blurriest image, samples[0], except this time the entire image is used
-    radius += 2
-    noutput = samples[0].copy() #thus we copy instead of blitting
-    pygame.draw.circle(noutput, (0,0,0), position, radius) #and the circle is now at the input position, since its full sized instead of a cutout
-    noutput.set_colorkey((0,0,0), pygame.RLEACCEL)
-    screen.blit(noutput, (0,0))
+#Draws a gaze-contingent window of window_radius around a position, over a background surface the size of the image.
+#Each frame only the previous window is restored to the background before the new one is drawn. Subclasses define
+#render(), which gives the window's pixels.
+class WindowCompositor:
+    def __init__(self, background, size, window_radius):
+        self.background = background
+        self.size = size #(width, height) of the image
+        self.radius = window_radius
+        self.previous = None
+
+    def draw(self, screen, position):
+        (width, height) = (min(screen.get_width(), self.size[0]), min(screen.get_height(), self.size[1]))
+        (pos_x, pos_y) = position
+        (left, top) = (max(pos_x - self.radius, 0), max(pos_y - self.radius, 0))
+        (right, bottom) = (min(pos_x + self.radius, width), min(pos_y + self.radius, height))
+
+        #only the last window needs restoring to the blurriest level, not the whole screen
+        if self.previous is None:
+            screen.blit(self.background, (0,0))
+        else:
+            screen.blit(self.background, self.previous, self.previous)
+        if right <= left or bottom <= top:
+            self.previous = None
+            return
+
+        rect = pygame.Rect(left, top, right - left, bottom - top)
+        pygame.surfarray.blit_array(screen.subsurface(rect), self.render(position, left, top, right, bottom).astype(np.uint8, copy=False))
+        self.previous = rect
+
+    #the window's pixels over the screen area [left, right) x [top, bottom), as a (width, height, 3) array
+    def render(self, position, left, top, right, bottom):
+        raise NotImplementedError("Compositors must define render().")
+
+#Draws the gaze-contingent window with numpy instead of per-level surfaces and colorkeys. The blur level of every pixel
+#in the window's bounding box depends only on its distance from the centre, so that map is computed once. Each frame
+#then copies the clear inner disc straight from the clearest level and gathers only the thin rings around it, through
+#precomputed flat indices into the stacked levels. Frame time no longer grows with the number of samples, and black
+#pixels in the image are no longer mistaken for transparency.
+#As with window(), samples[0] is the blurriest level (used everywhere outside the window) and samples[-1] the clearest.
+#With smooth set, each pixel is an alpha blend of the two levels its distance falls between instead of a hard ring.
+class Compositor(WindowCompositor):
+    def __init__(self, samples, window_radius, smooth=True, ring_width=2):
+        self.levels = np.stack([pygame.surfarray.array3d(sample) for sample in samples])
+        WindowCompositor.__init__(self, samples[0], self.levels.shape[1:3], window_radius)
+        self.smooth = smooth
+
+        count = len(samples)
+        inner = window_radius - (count * ring_width) #radius of the clearest level, the rest are rings around it
+        offsets = np.arange(-window_radius, window_radius, dtype=np.float32) + 0.5
+        distance = np.sqrt(offsets[:,np.newaxis]**2 + offsets[np.newaxis,:]**2)
+        level = (count - 1) - np.clip((distance - inner) / ring_width, 0, count - 1)
+        if not smooth:
+            level = np.floor(level)
+        lower = np.floor(level).astype(np.intp)
+        alpha = (level - lower).astype(np.float32)
+
+        #Inside the inner disc every pixel is the clearest level, and beyond the rings the blurriest, so a frame starts
+        #from the blurriest level and copies the disc in whole. Only the rings between are gathered, through flat byte
+        #indices into the stacked levels for a window at (0, 0) (adding the window's origin moves them), and only the
+        #pixels strictly between two levels are blended with the level above.
+        self.disc = np.repeat((lower == count - 1)[:,:,np.newaxis], 3, axis=2)
+        self.level_bytes = self.levels[0].size
+        self.gathers = []
+        for (mask, blended) in (((lower > 0) & (lower < count - 1) & (alpha == 0), False), (alpha > 0, True)):
+            (x, y) = np.nonzero(mask)
+            first = (lower[mask] * self.levels.shape[1] * self.levels.shape[2] + x * self.levels.shape[2] + y)[:,np.newaxis] * 3 + np.arange(3)
+            self.gathers.append((x, y, first, alpha[mask][:,np.newaxis] if blended else None))
+
+    def render(self, position, left, top, right, bottom):
+        (x0, y0) = (position[0] - self.radius, position[1] - self.radius)
+        out = self.levels[0, left:right, top:bottom].copy()
+        np.copyto(out, self.levels[-1, left:right, top:bottom], where=self.disc[left - x0:right - x0, top - y0:bottom - y0])
+
+        clipped = (left, top, right, bottom) != (x0, y0, x0 + 2 * self.radius, y0 + 2 * self.radius)
+        (levels, pixels) = (self.levels.reshape(-1), out.reshape(-1))
+        origin = 3 * (x0 * self.levels.shape[2] + y0)
+        for (x, y, first, alpha) in self.gathers:
+            if clipped: #only the part of the box on screen
+                inside = (x >= left - x0) & (x < right - x0) & (y >= top - y0) & (y < bottom - y0)
+                (x, y, first) = (x[inside], y[inside], first[inside])
+                alpha = alpha[inside] if alpha is not None else None
+            source = first + origin
+            value = np.take(levels, source)
+            if alpha is not None:
+                value = (value + (np.take(levels, source + self.level_bytes).astype(np.float32) - value) * alpha).astype(np.uint8)
+            np.put(pixels, ((x - (left - x0)) * (bottom - top) + (y - (top - y0)))[:,np.newaxis] * 3 + np.arange(3), value)
+        return out
+
+#Foveates continuously instead of with a fixed set of levels: every pixel in the window gets the cutoff
+#blur.eccentricityCutoff gives for its eccentricity, synthesized from a blur.BlurPyramid built once. The falloff is
+#scaled so that it reaches cpd, the cutoff used everywhere outside the window, exactly at the window's edge.
+class FoveatedCompositor(WindowCompositor):
+    def __init__(self, matrix, cpd, window_radius, fovea_cpd=40.0):
+        self.pyramid = blur.BlurPyramid(matrix)
+        self.cpd = cpd
+        self.fovea_cpd = fovea_cpd
+        background = blur.exportToPygame(blur.BlurringMatrix(self.pyramid.synthesize(cpd)))
+        WindowCompositor.__init__(self, background, matrix.matrix.shape[:2], window_radius)
+
+        #solves eccentricityCutoff(edge) == cpd for the eccentricity at which resolution halves
+        edge = window_radius / matrix.pixels_per_degree
+        self.half_resolution_eccentricity = edge / max(fovea_cpd / float(cpd) - 1, 1e-6)
+
+        #like the level map of Compositor, the pyramid position of each pixel in the window's box is computed once
+        offsets = np.arange(-window_radius, window_radius, dtype=np.float32) + 0.5
+        eccentricity = np.sqrt(offsets[:,np.newaxis]**2 + offsets[np.newaxis,:]**2) / matrix.pixels_per_degree
+        self.positions = self.pyramid.levelPositions(self.falloff(eccentricity))
+
+    def falloff(self, eccentricity):
+        return np.maximum(self.cpd, blur.eccentricityCutoff(eccentricity, self.fovea_cpd, self.half_resolution_eccentricity))
+
+    def render(self, position, left, top, right, bottom):
+        (pos_x, pos_y) = position
+        crop = (slice(left - (pos_x - self.radius), right - (pos_x - self.radius)), slice(top - (pos_y - self.radius), bottom - (pos_y - self.radius)))
+        return self.pyramid.collapse(self.positions[crop], slice(left, right), slice(top, bottom))
+
+_compositor = None
+
+#opens the image and builds a FoveatedCompositor for it, an alternative to make_window_prereqs and Compositor
+def make_foveated_compositor(cpd, filename, window_radius=300):
+    try:
+        generator = blur.open(filename, blur.Types.PYGAME, dtype='float32')
+    except IOError:
+        print("Could not open {0} as an image. Exiting.".format(filename))
+        exit(-1)
+    generator.calcPixelsPerDegree((1024, 768), (36, 27), 61)
+    return FoveatedCompositor(generator, cpd, window_radius)
+
+#Given a screen, list of samples, radius, and position, a clear window is drawn with a gradient edge.
+#Kept for existing callers; it reuses one Compositor for as long as the samples and radius stay the same.
+def window(screen, samples, window_radius, position, smooth=False):
+    global _compositor
+    key = (tuple(id(sample) for sample in samples), window_radius, smooth)
+    if _compositor is None or _compositor[0] != key:
+        _compositor = (key, Compositor(samples, window_radius, smooth))
+    _compositor[1].draw(screen, position)
 
 def main():
     parser = argparse.ArgumentParser(description="Takes in a file and applies a low-pass blur filter. Supported formats are tif, jpg, png, bmp, and gif.")
     parser.add_argument("cycles_per_degree", type=float, help="The lower bound cycles per degree of the filter.")
     parser.add_argument("source_file", help="Filename of the image to apply the filter to.")
     parser.add_argument("-concurrent, -c", dest="concurrent", action="store_true", help="If set, the blur will be generated concurrently. Only supported under Python 3.x and up.")
+    parser.add_argument("--pyramid", action="store_true", help="Foveate continuously from a blur pyramid instead of using a fixed set of blur levels.")
+    parser.add_argument("--hard-edges", dest="smooth", action="store_false", help="Draw each blur level as a hard-edged ring instead of blending between neighbouring levels.")
 
     args = parser.parse_args()
 
     cpd = args.cycles_per_degree
     filename = args.source_file
 
-    pygame.init()
+    pygame.display.init() #the only pygame module used, and much quicker to start than all of them
 
-    samples = make_window_prereqs(cpd, filename, concurrent=args.concurrent)
+    if args.pyramid:
+        compositor = make_foveated_compositor(cpd, filename, 300)
+    else:
+        samples = make_window_prereqs(cpd, filename, concurrent=args.concurrent)
+        compositor = Compositor(samples, 300, smooth=args.smooth)
     
     screen = pygame.display.set_mode((1024,768))
 
-    screen.blit(samples[0], (0,0))
-
     running = True
     frame_times = []
     print("average frame time: 0ms")
     while running:
         t1 = time.time()
-        window(screen, samples, 300, pygame.mouse.get_pos())
+        compositor.draw(screen, pygame.mouse.get_pos())
         t2 = time.time()
         frame_times.append((t2 - t1) * 1000.0)
         pygame.display.flip()
@@ -29,7 +29,7 @@ else:
     gen.calcPixelsPerDegree((1024, 768), (36, 27), 61)
 #    print "calc took {0}".format((time.time() - s2) * 1000.0)
     s2 = time.time()
-    gen =  gen.applyLowPassFilter(cpd, concurrent=True)
+    gen =  gen.lowPassFilter(cpd, concurrent=True)
     print("filter took {0}".format((time.time() - s2) * 1000.0))
     s2 = time.time()
     out = blur.exportToPygame(gen)